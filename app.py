@@ -1,12 +1,23 @@
 import os
-import json
+import re
+import hashlib
+import asyncio
+import logging
+import threading
+import uuid
+from datetime import timedelta
+from functools import lru_cache
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, session
-from openai import OpenAI
+import orjson
+import tiktoken
+from flask import Flask, Response, g, render_template, request, session
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
-from tools.tool_registry import call_tool
 from tools.tool_specs import geospatial_tools
 from flask import send_from_directory
+from werkzeug.security import safe_join
 
 
 load_dotenv()
@@ -16,14 +27,126 @@ load_dotenv()
 # --------------------------------------------------
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+app.logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# Keep chat history + map state server-side in Redis when REDIS_URL is set,
+# so the cookie only carries a session id. Falls back to Flask's signed
+# cookie session otherwise (local dev, tests).
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    import redis
+    from flask_session import Session
+
+    redis_client = redis.Redis.from_url(REDIS_URL)
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis_client
+    app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(hours=1)
+    Session(app)
+
+# Tool calls over large areas run on an RQ worker (`python worker.py`) when
+# Redis is configured; the chat request returns a job id to poll instead.
+rq_queue = None
+if redis_client is not None:
+    from rq import Queue
+
+    rq_queue = Queue("tools", connection=redis_client)
+
+# One pooled HTTP/2 connection set shared by every request, so bursts reuse
+# warm TLS connections to the API. The SDK's default pool limits
+# (1000 connections / 100 keep-alive) already fit; connects fail fast.
+# Retries are handled by create_completion() below, not inside the SDK.
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,
+    http_client=openai.DefaultAsyncHttpxClient(http2=True, timeout=openai.Timeout(60, connect=5)),
+)
 ai_model='gpt-4o-mini'
 
+# Flask runs each async view in a fresh event loop, while AsyncOpenAI keeps
+# pooled connections bound to the loop that opened them. All OpenAI calls
+# therefore run on one long-lived background loop shared by every request.
+_openai_loop = asyncio.new_event_loop()
+threading.Thread(target=_openai_loop.run_forever, name="openai-loop", daemon=True).start()
+
+
+def run_on_openai_loop(coro):
+    """
+    Schedule a coroutine on the shared OpenAI loop and await it from the
+    current request's loop.
+    """
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, _openai_loop))
+
+
+# Client-side cap on in-flight OpenAI requests so traffic spikes queue here
+# instead of tripping the account's rate limit. Only used on _openai_loop.
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "20")))
+
+_backoff = wait_exponential_jitter(initial=1, max=30)
+
+
+def _wait_retry_after(retry_state) -> float:
+    """Exponential backoff, but never shorter than the server's Retry-After."""
+    wait = _backoff(retry_state)
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    try:
+        return max(wait, float(response.headers.get("retry-after")))
+    except (AttributeError, TypeError, ValueError):
+        return wait
+
+
+@retry(
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def create_completion(**kwargs):
+    """client.chat.completions.create with retries on 429 and transient errors."""
+    # acquired per attempt, so backoff sleeps don't hold a slot
+    async with OPENAI_SEM:
+        return await client.chat.completions.create(**kwargs)
+
 
 
 OUTPUT_DIR = os.path.join(app.root_path, "output")
 
+
+def _warmup_tools():
+    try:
+        from tools.buildings_analysis import warmup
+        warmup()
+    except FileNotFoundError as e:
+        app.logger.warning("Skipping building data warmup: %s", e)
+    except Exception:
+        app.logger.exception("Building data warmup failed")
+
+
+# Load the building data + spatial index in the background once a process
+# serves its first request (usually the page load, well before the first
+# chat), so only serving workers load it: not the `python app.py` parent,
+# not scripts or tests that merely import the app.
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1") == "1"
+_warmup_lock = threading.Lock()
+_warmup_started = False
+
+
+@app.before_request
+def _start_warmup():
+    global _warmup_started
+    if _warmup_started or not WARMUP_ON_START:
+        return
+    with _warmup_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+    threading.Thread(target=_warmup_tools, name="tools-warmup", daemon=True).start()
+
 # --------------------------------------------------
 # Constants
 # --------------------------------------------------
@@ -51,9 +174,76 @@ Always explain:
 Do NOT fabricate numbers or analysis results.
 """.strip()
 
-DEFAULT_MAP_CENTER = [52.3730796, 4.8924534]  # Amsterdam (lat, lon)
+TOOL_GUIDELINES = """
+Tool usage guidelines:
+- Coordinates are WGS84. A point drawn on the map arrives in the message as
+  GeoJSON with coordinates [lon, lat]; pass them as separate lat and lon
+  arguments and never swap them.
+- Radius arguments are in meters. Convert kilometers to meters. When the user
+  gives no radius, use the tool default (400 m). Valid radii are 1-15000 m.
+- If the user names a place instead of giving coordinates, use
+  geocode_location to show it; building analysis needs a point (lat/lon).
+- Building analysis tools only cover the municipality of Utrecht. If a tool
+  reports that the location is outside Utrecht, relay that message.
+- Building height is the ridge height above ground level
+  (b3_h_nok - b3_h_maaiveld) from 3DBAG, in meters.
+- Footprint area is the ground floor area in square meters; volume is the
+  3DBAG LoD 2.2 volume in cubic meters (falling back to LoD 1.3 / 1.2).
+- Pick exactly the tool that matches the question: counts and maps of
+  buildings -> buildings_within_buffer; a height threshold ->
+  buildings_higher_than_within_buffer; min/avg/max height ->
+  height_stats_within_buffer; the single tallest building ->
+  tallest_building_within_buffer; footprint statistics ->
+  footprint_stats_within_buffer; total volume -> total_volume_within_buffer.
+  When one question asks for several of height, footprint, volume and the
+  tallest building at the same point, call analyze_buffer once instead.
+- Report the numbers exactly as returned by the tool, with units. Round to
+  one decimal for heights and areas and to whole numbers for volumes.
+- Results are drawn on the map automatically; mention what is shown instead
+  of describing file names or URLs.
+""".strip()
+
+
+def _tool_capability_card(tools: list[dict]) -> str:
+    """
+    Render the tool specs as a compact capability card for the system prompt.
+    """
+    lines = []
+    for tool in tools:
+        fn = tool["function"]
+        params = fn.get("parameters", {})
+        required = set(params.get("required", []))
+
+        args = []
+        for name, spec in params.get("properties", {}).items():
+            arg = f"{name}: {spec.get('type', 'any')}"
+            if name not in required and "default" in spec:
+                arg += f" = {spec['default']}"
+            args.append(arg)
+
+        lines.append(f"- {fn['name']}({', '.join(args)})\n  {fn.get('description', '')}")
+    return "\n".join(lines)
+
+
+# Built once at import: OpenAI caches identical prompt prefixes (tools +
+# system message) beyond 1024 tokens, so nothing per-request may go in here.
+CACHED_SYSTEM_PROMPT = "\n\n".join([
+    SYSTEM_PROMPT,
+    "Available tools:\n" + _tool_capability_card(geospatial_tools),
+    TOOL_GUIDELINES,
+])
+
+# Shared by every request; messages lists reference it, never mutate it.
+SYSTEM_MSG = {"role": "system", "content": CACHED_SYSTEM_PROMPT}
+
+DEFAULT_MAP_CENTER = (52.3730796, 4.8924534)  # Amsterdam (lat, lon); copied into each session
 DEFAULT_MAP_ZOOM = 12
 
+# Chat history kept in the session: last N messages (user + assistant) and
+# at most HISTORY_TOKEN_BUDGET tokens; older turns are dropped.
+MAX_HISTORY_MESSAGES = 20
+HISTORY_TOKEN_BUDGET = 3000
+
 
 # --------------------------------------------------
 # Helpers: session state
@@ -64,10 +254,69 @@ def ensure_state():
     Replaces Streamlit's st.session_state.
     """
     session.setdefault("messages", [])  # list of {"role": "...", "content": "..."}
-    session.setdefault("map_center", DEFAULT_MAP_CENTER)
+    session.setdefault("map_center", list(DEFAULT_MAP_CENTER))
     session.setdefault("map_zoom", DEFAULT_MAP_ZOOM)
     session.setdefault("map_layers", [])  # list of layer dicts
 
+    # A streamed reply finishes after the session was saved; pick it up now.
+    reply_id = session.get("pending_reply")
+    if reply_id:
+        text = _pop_pending_reply(reply_id)
+        if text is not None:
+            session.pop("pending_reply")
+            if text:  # empty: the stream failed, there is no answer to keep
+                session["messages"].append({"role": "assistant", "content": text})
+                trim_history()
+
+
+@lru_cache(maxsize=1)
+def _token_encoder():
+    try:
+        return tiktoken.encoding_for_model(ai_model)
+    except Exception:
+        # tiktoken downloads its encodings on first use; estimate when offline
+        app.logger.warning("tiktoken encoding unavailable, estimating token counts")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = _token_encoder()
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text))
+
+
+def trim_history():
+    """
+    Keep session["messages"] within MAX_HISTORY_MESSAGES and
+    HISTORY_TOKEN_BUDGET. The history is only shown in the chat UI; the
+    model calls don't send it, so older messages are simply dropped.
+    """
+    messages = session["messages"]
+    keep = messages[-MAX_HISTORY_MESSAGES:]
+
+    tokens = sum(count_tokens(m["content"]) for m in keep)
+    while len(keep) > 1 and tokens > HISTORY_TOKEN_BUDGET:
+        tokens -= count_tokens(keep.pop(0)["content"])
+
+    if len(keep) < len(messages):
+        session["messages"] = keep
+
+
+# Streamed (SSE) replies complete after the response headers - and with them
+# the session - have been sent, so the final text is parked in Redis until
+# ensure_state() moves it into the session. Every worker sees Redis, so
+# streaming is only offered when it is configured (see api_chat).
+def _store_pending_reply(reply_id: str, text: str) -> None:
+    redis_client.setex(f"reply:{reply_id}", 3600, text)
+
+
+def _pop_pending_reply(reply_id: str) -> str | None:
+    if redis_client is None:
+        return None
+    text = redis_client.getdel(f"reply:{reply_id}")
+    return text.decode() if text is not None else None
+
 
 def apply_map_from_tool_result(tool_result: dict) -> bool:
     """
@@ -82,12 +331,35 @@ def apply_map_from_tool_result(tool_result: dict) -> bool:
         if "zoom" in m:
             session["map_zoom"] = m["zoom"]; changed = True
         if "layers" in m:
-            session["map_layers"] = m["layers"]; changed = True
+            # Inline GeoJSON is only sent with this response; the session
+            # keeps the layer's URL so it stays small.
+            session["map_layers"] = [_without_inline(l) for l in m["layers"]]
+            g.inline_geojson = {l["url"]: l["geojson"] for l in m["layers"] if "url" in l and "geojson" in l}
+            changed = True
 
         return changed
 
     return False
 
+
+def _without_inline(layer: dict) -> dict:
+    if "url" in layer and "geojson" in layer:
+        return {k: v for k, v in layer.items() if k != "geojson"}
+    return layer
+
+
+def current_map_payload() -> dict:
+    """Session map state, with this request's inline GeoJSON attached."""
+    inline = g.get("inline_geojson", {})
+    return {
+        "center": session["map_center"],
+        "zoom": session["map_zoom"],
+        "layers": [
+            {**l, "geojson": inline[l["url"]]} if l.get("url") in inline else l
+            for l in session["map_layers"]
+        ],
+    }
+
 # def chat_with_bouwbot(messages: list[dict]) -> tuple[str, bool]:
 #     map_updated = False
 
@@ -141,32 +413,197 @@ def apply_map_from_tool_result(tool_result: dict) -> bool:
 #     return (followup.choices[0].message.content or "No content returned.", map_updated)
 
 
-def chat_with_bouwbot(user_text: str) -> tuple[str, bool]:
+def _log_prompt_cache(phase: str, response) -> None:
+    """Log how much of the prompt was served from OpenAI's prefix cache."""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    if usage is not None and details is not None:
+        app.logger.debug(
+            "%s prompt tokens: %s (cached: %s)",
+            phase, usage.prompt_tokens, details.cached_tokens,
+        )
+
+
+# --------------------------------------------------
+# Intent routing (before any OpenAI call)
+# --------------------------------------------------
+# Only messages that are clearly about something else (and mention nothing
+# from ON_TOPIC_RE) are answered locally; the model would only refuse them.
+# Everything else goes to the model: a false "on topic" costs one model
+# call, a false "off topic" a wrong answer (place names can't be listed).
+OFF_TOPIC_RE = re.compile(
+    r"\b(jokes?|grap(je)?|weather|weer|recipes?|recept(en)?|poems?|gedicht(en)?|"
+    r"songs?|liedje|stocks?|aandelen|bitcoin|crypto|interest\s+rates?|rente|"
+    r"news|nieuws|football|voetbal|translate|vertaal)\b",
+    re.IGNORECASE,
+)
+
+ON_TOPIC_RE = re.compile(
+    r"building|gebouw|pand|buffer|tall|highest|height|hoog|radius|meter|"
+    r"footprint|volume|map|kaart|show|locat|point|where|street|straat|"
+    r"house|huis|huizen|woning|toren|tower|near|within|"
+    r"coordinates|utrecht|amsterdam|rotterdam|netherlands|nederland",
+    re.IGNORECASE,
+)
+
+OFF_TOPIC_REPLY = (
+    "I can only answer questions about Dutch building data, for example: "
+    "buildings within a radius of a point, building heights, the tallest "
+    "building, footprint or volume statistics, or showing a place on the map."
+)
+
+# A tool is only forced when exactly one of these matches: forcing one
+# function rules out any other call in the turn, so a question that asks
+# for two things is left to the model (tool_choice="auto").
+TOOL_INTENTS = [
+    ("tallest_building_within_buffer", re.compile(r"\b(tallest|highest)\b", re.IGNORECASE)),
+    ("footprint_stats_within_buffer", re.compile(r"footprint", re.IGNORECASE)),
+    ("total_volume_within_buffer", re.compile(r"\bvolume\b", re.IGNORECASE)),
+    ("buildings_higher_than_within_buffer", re.compile(r"\b(higher|taller)\s+than\b", re.IGNORECASE)),
+    ("height_stats_within_buffer", re.compile(r"height\s+stat|\b(min|minimum)\b.*\b(max|maximum)\b", re.IGNORECASE)),
+]
+
+# Generic requests, used only when none of TOOL_INTENTS matches (every
+# specific question also mentions buildings within a radius); first wins.
+FALLBACK_INTENTS = [
+    ("buildings_within_buffer", re.compile(r"\bbuildings?\b.*\bwithin\b", re.IGNORECASE)),
+    ("buffer_point", re.compile(r"\bbuffer\b", re.IGNORECASE)),
+]
+
+# Questions asking for two or more of these go to analyze_buffer, which
+# answers them all from one buffer query.
+METRIC_INTENTS = [
+    re.compile(r"\b(tallest|highest)\b", re.IGNORECASE),
+    re.compile(r"\bheights?\b|\b(min|minimum)\b.*\b(max|maximum)\b", re.IGNORECASE),
+    re.compile(r"footprint", re.IGNORECASE),
+    re.compile(r"\bvolume\b", re.IGNORECASE),
+]
+
+# All routed tools need a point; only force one when the message has it.
+POINT_RE = re.compile(r'"coordinates"|-?\d{1,2}\.\d+\s*,\s*-?\d{1,3}\.\d+')
+
+
+def route_intent(user_text: str) -> tuple[bool, str | None]:
+    """
+    Cheap rule-based routing. Returns (on_topic, tool_name); tool_name is
+    set when the query clearly maps to one tool and includes a point.
+    """
+    if OFF_TOPIC_RE.search(user_text) and not ON_TOPIC_RE.search(user_text):
+        return False, None
+    if not POINT_RE.search(user_text):
+        return True, None
+    if sum(1 for pattern in METRIC_INTENTS if pattern.search(user_text)) >= 2:
+        return True, "analyze_buffer"
+
+    matches = [name for name, pattern in TOOL_INTENTS if pattern.search(user_text)]
+    if matches:
+        return True, matches[0] if len(matches) == 1 else None
+    for name, pattern in FALLBACK_INTENTS:
+        if pattern.search(user_text):
+            return True, name
+    return True, None
+
+
+# Request options that never change between calls, built once at import.
+TOOL_PHASE_KWARGS = dict(
+    model=ai_model,
+    tools=geospatial_tools,
+    tool_choice="auto",
+    temperature=0.2,
+    max_tokens=300,
+)
+
+
+# Buffer tools with a larger radius than this go to the background queue.
+LONG_TOOL_RADIUS_M = float(os.getenv("LONG_TOOL_RADIUS_M", "1000"))
+
+
+def _is_long_tool_call(name: str, args: dict) -> bool:
+    try:
+        radius = float(args.get("radius_m") or 0)
+    except (TypeError, ValueError):
+        return False
+    return (name.endswith("_within_buffer") or name == "analyze_buffer") and radius > LONG_TOOL_RADIUS_M
+
+
+def append_tool_results(messages: list[dict], calls: list[dict], results: list[dict]) -> bool:
+    """
+    Add tool results to messages and apply their map updates to the session.
+    Returns True if the map was updated.
+    """
     map_updated = False
+    for call, result in zip(calls, results):
+        app.logger.debug("tool call: %s", call["name"])
+
+        if apply_map_from_tool_result(result):
+            map_updated = True
+
+        messages.append({
+            "role": "tool",
+            "tool_call_id": call["id"],
+            "name": call["name"],
+            "content": orjson.dumps(_for_model(result), option=orjson.OPT_SERIALIZE_NUMPY).decode(),
+        })
+    return map_updated
+
+
+def _for_model(result: dict) -> dict:
+    """Tool result without inline GeoJSON, which the model has no use for."""
+    m = result.get("map")
+    if not isinstance(m, dict) or not isinstance(m.get("layers"), list):
+        return result
+    return {**result, "map": {**m, "layers": [_without_inline(l) for l in m["layers"]]}}
+
+
+def enqueue_tool_calls(messages: list[dict], calls: list[dict]) -> str:
+    """
+    Run the tool calls on the RQ worker and park the conversation so far in
+    Redis. Returns the turn id polled via /api/chat/status/<id>.
+    """
+    job = rq_queue.enqueue(
+        "tools.tool_registry.call_tools",
+        [(c["name"], c["args"]) for c in calls],
+        result_ttl=3600,
+    )
+    turn_id = uuid.uuid4().hex
+    turn = {"job_id": job.id, "messages": messages[1:], "calls": calls}  # system message is re-added
+    redis_client.setex(f"turn:{turn_id}", 3600, orjson.dumps(turn))
+    return turn_id
+
+
+async def run_tool_phase(user_text: str) -> tuple[list[dict], str | None, bool, str | None]:
+    """
+    Phase 1 (tool decision) + tool execution.
+    Returns (messages, reply, map_updated, job_id); reply is set when the
+    model answered directly and no follow-up call is needed, job_id when
+    the tools were handed to the background queue.
+    """
 
     # --------------------------------------------------
     # PHASE 1: TOOL DECISION (NO HISTORY)
     # --------------------------------------------------
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": user_text},
-    ]
+    messages = [SYSTEM_MSG, {"role": "user", "content": user_text}]
 
-    response = client.chat.completions.create(
-        model=ai_model,
-        messages=messages,
-        tools=geospatial_tools,
-        tool_choice="auto",
-        temperature=0.2,
-        max_tokens=300,
-    )
+    on_topic, tool_name = route_intent(user_text)
+    if not on_topic:
+        return messages, OFF_TOPIC_REPLY, False, None
+
+    kwargs = TOOL_PHASE_KWARGS
+    if tool_name:
+        kwargs = {**kwargs, "tool_choice": {"type": "function", "function": {"name": tool_name}}}
+
+    response = await run_on_openai_loop(create_completion(
+        messages=messages, **kwargs,
+    ))
 
     msg = response.choices[0].message
-    print("msg",msg)
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("phase-1 message: %s", msg.model_dump_json())
+    _log_prompt_cache("phase-1", response)
 
     # If no tool call → just return text
     if not getattr(msg, "tool_calls", None):
-        return (msg.content or "No reply generated.", False)
+        return messages, msg.content or "No reply generated.", False, None
 
     # --------------------------------------------------
     # Execute tool calls
@@ -180,35 +617,173 @@ def chat_with_bouwbot(user_text: str) -> tuple[str, bool]:
 
 
 
-    for tc in msg.tool_calls:
-        function_name = tc.function.name
-        print("function_name",function_name)
-        arguments = json.loads(tc.function.arguments or "{}")
+    calls = [
+        {"id": tc.id, "name": tc.function.name, "args": orjson.loads(tc.function.arguments or "{}")}
+        for tc in msg.tool_calls
+    ]
 
-        result = call_tool(function_name, arguments)
-        # print("result",result) 
+    # Imported here so importing the app doesn't pull in the geopandas/shapely
+    # stack; the warmup thread or the first tool call loads it.
+    from tools.tool_registry import call_tool, tool_result_cached
 
-        if apply_map_from_tool_result(result):
-            map_updated = True
+    # Large-area queries go to the worker unless their results are cached.
+    if rq_queue is not None and any(
+        _is_long_tool_call(c["name"], c["args"]) and not tool_result_cached(c["name"], c["args"])
+        for c in calls
+    ):
+        return messages, None, False, enqueue_tool_calls(messages, calls)
 
-        messages.append({
-            "role": "tool",
-            "tool_call_id": tc.id,
-            "name": function_name,
-            "content": json.dumps(result),
-        })
+    # Tools are sync geopandas/shapely work: run them side by side in worker
+    # threads, then consume the results in the original tool_calls order.
+    results = await asyncio.gather(*[
+        asyncio.to_thread(call_tool, c["name"], c["args"]) for c in calls
+    ])
 
-    # --------------------------------------------------
-    # PHASE 2: FOLLOW-UP RESPONSE (WITH TOOL RESULTS)
-    # --------------------------------------------------
-    followup = client.chat.completions.create(
-        model=ai_model,
-        messages=messages,
-        temperature=0.2,
-        max_tokens=400,
+    map_updated = append_tool_results(messages, calls, results)
+    return messages, None, map_updated, None
+
+
+# --------------------------------------------------
+# PHASE 2: FOLLOW-UP RESPONSE (WITH TOOL RESULTS)
+# --------------------------------------------------
+# Same tools + system prefix as phase 1 so the follow-up also hits the
+# prompt cache; tool_choice="none" keeps it a plain text answer.
+FOLLOWUP_KWARGS = dict(
+    model=ai_model,
+    tools=geospatial_tools,
+    tool_choice="none",
+    temperature=0.2,
+    max_tokens=400,
+)
+
+
+async def followup_reply(messages: list[dict]) -> str:
+    followup = await run_on_openai_loop(create_completion(
+        messages=messages, **FOLLOWUP_KWARGS,
+    ))
+    _log_prompt_cache("phase-2", followup)
+
+    return followup.choices[0].message.content or "No content returned."
+
+
+async def chat_with_bouwbot(user_text: str) -> tuple[str | None, bool, str | None]:
+    """Returns (reply, map_updated, job_id); reply is None for queued jobs."""
+    messages, reply, map_updated, job_id = await run_tool_phase(user_text)
+    if reply is not None or job_id is not None:
+        return (reply, map_updated, job_id)
+
+    return (await followup_reply(messages), map_updated, None)
+
+
+def stream_followup(messages: list[dict]):
+    """
+    Yield phase-2 text deltas as they arrive. This is a sync generator (Flask
+    streams plain iterators); each chunk is pulled from the OpenAI loop.
+    """
+    async def _open():
+        return await create_completion(messages=messages, stream=True, **FOLLOWUP_KWARGS)
+
+    stream = asyncio.run_coroutine_threadsafe(_open(), _openai_loop).result()
+    chunks = stream.__aiter__()
+
+    async def _next():
+        return await chunks.__anext__()
+
+    while True:
+        try:
+            chunk = asyncio.run_coroutine_threadsafe(_next(), _openai_loop).result()
+        except StopAsyncIteration:
+            break
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def json_response(payload: dict, status: int = 200) -> Response:
+    """Drop-in for jsonify that encodes with orjson."""
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype="application/json",
     )
 
-    return (followup.choices[0].message.content or "No content returned.", map_updated)
+
+def json_stream(payload: dict):
+    """
+    Encode a dict one top-level key at a time, so a large chat response
+    (history + map layers) is never held as a single encoded string.
+    """
+    yield b"{"
+    for i, (key, value) in enumerate(payload.items()):
+        if i:
+            yield b","
+        yield orjson.dumps(key) + b":"
+        yield orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+    yield b"}"
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+async def stream_chat(user_text: str) -> Response:
+    """
+    SSE variant of the chat turn: tools run first, then the map payload and
+    the phase-2 answer are streamed as `map`, `delta` and `done` events.
+    """
+    messages, reply, map_updated, job_id = await run_tool_phase(user_text)
+
+    if job_id is not None:
+        def job_events():
+            yield _sse("job", {"job_id": job_id})
+
+        return Response(job_events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    map_payload = None
+    if map_updated:
+        map_payload = current_map_payload()
+
+    reply_id = None
+    if reply is not None:
+        session["messages"].append({"role": "assistant", "content": reply})
+        trim_history()
+    else:
+        reply_id = uuid.uuid4().hex
+        session["pending_reply"] = reply_id
+
+    def events():
+        if map_payload:
+            yield _sse("map", map_payload)
+
+        if reply is not None:
+            yield _sse("delta", {"content": reply})
+            yield _sse("done", {"reply": reply})
+            return
+
+        parts = []
+        completed = False
+        try:
+            for delta in stream_followup(messages):
+                parts.append(delta)
+                yield _sse("delta", {"content": delta})
+            completed = True
+        except Exception:
+            app.logger.exception("Streaming follow-up failed")
+        finally:
+            # a failed or abandoned stream stores "", so ensure_state() clears
+            # the pending reply without keeping a partial answer
+            text = ("".join(parts) or "No content returned.") if completed else ""
+            _store_pending_reply(reply_id, text)
+
+        if not completed:
+            yield _sse("error", {"error": "Streaming failed"})
+            return
+        yield _sse("done", {"reply": text})
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 
@@ -219,23 +794,30 @@ def index():
 
 
 @app.post("/api/chat")
-def api_chat():
+async def api_chat():
     ensure_state()
 
     payload = request.get_json(force=True, silent=True) or {}
     # map_context = payload.get("map_context") or {}
     # draw_geojson = map_context.get("draw_geojson") 
     user_text = (payload.get("message") or "").strip()
-    print("user_text",user_text)
-    # print("draw_geojson",draw_geojson)
+    app.logger.debug("user_text: %s", user_text)
 
 
     if not user_text:
-        return jsonify({"ok": False, "error": "Empty message"}), 400
+        return json_response({"ok": False, "error": "Empty message"}, 400)
 
 
     # store user message
     session["messages"].append({"role": "user", "content": user_text})
+    trim_history()
+
+    # clients that accept SSE get the answer streamed token by token; the
+    # streamed reply is handed back through Redis, so only when it's there
+    if redis_client is not None and request.accept_mimetypes.best_match(
+        ["application/json", "text/event-stream"]
+    ) == "text/event-stream":
+        return await stream_chat(user_text)
 
     # build messages
     # messages = [{"role": "system", "content": SYSTEM_PROMPT}]
@@ -244,11 +826,15 @@ def api_chat():
     # messages.extend(session["messages"])
 
     # run tool loop
-    assistant_text, map_updated = chat_with_bouwbot(user_text)
+    assistant_text, map_updated, job_id = await chat_with_bouwbot(user_text)
     # assistant_text, map_updated = chat_with_bouwbot(messages)
+
+    if job_id is not None:
+        return json_response({"ok": True, "status": "running", "job_id": job_id, "messages": session["messages"]})
+
     session["messages"].append({"role": "assistant", "content": assistant_text})
-    print("map_updated",map_updated)
-    print("map_center",session["map_center"])
+    trim_history()
+    app.logger.debug("map_updated=%s map_center=%s", map_updated, session["map_center"])
 
 
     resp = {
@@ -259,27 +845,107 @@ def api_chat():
 
     # ✅ only include map if it changed in this request
     if map_updated:
-        resp["map"] = {
-            "center": session["map_center"],
-            "zoom": session["map_zoom"],
-            "layers": session["map_layers"],
-        }
+        resp["map"] = current_map_payload()
+
+    return Response(json_stream(resp), mimetype="application/json")
 
-    return jsonify(resp)
 
 
 
 
+CONTENT_ADDRESSED_RE = re.compile(r"_[0-9a-f]{16}\.geojsonl?$")
+
 
 @app.get("/output/<path:filename>")
 def serve_generated(filename):
-    return send_from_directory(OUTPUT_DIR, filename, mimetype="application/geo+json")
+    mimetype = "application/geo+json-seq" if filename.endswith(".geojsonl") else "application/geo+json"
+
+    # Exports have a gzip copy next to them; send it as-is when accepted.
+    gz_filename = f"{filename}.gz"
+    gz_path = safe_join(OUTPUT_DIR, gz_filename)
+    if "gzip" in request.accept_encodings and gz_path and os.path.isfile(gz_path):
+        resp = send_from_directory(
+            OUTPUT_DIR, gz_filename, mimetype=mimetype, conditional=True, download_name=filename
+        )
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = send_from_directory(OUTPUT_DIR, filename, mimetype=mimetype, conditional=True)
+
+    resp.headers["Vary"] = "Accept-Encoding"
+
+    # <prefix>_<sha1>.geojson(l) names change whenever the content does
+    if CONTENT_ADDRESSED_RE.search(filename):
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+
+@app.get("/api/chat/status/<job_id>")
+async def api_chat_status(job_id):
+    """
+    Poll a queued tool job. Once the worker is done, the follow-up answer
+    is generated here and the turn is added to the session like /api/chat.
+    """
+    ensure_state()
+
+    raw = redis_client.get(f"turn:{job_id}") if redis_client is not None else None
+    if raw is None:
+        return json_response({"ok": False, "error": "Unknown job"}, 404)
+
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job, JobStatus
+
+    turn = orjson.loads(raw)
+    try:
+        job = Job.fetch(turn["job_id"], connection=redis_client)
+        status = job.get_status()
+    except NoSuchJobError:
+        # the job (or its result) expired before it was picked up
+        redis_client.delete(f"turn:{job_id}")
+        return json_response({"ok": False, "status": "failed", "error": "Job expired"}, 404)
+
+    if status in (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED):
+        redis_client.delete(f"turn:{job_id}")
+        return json_response({"ok": False, "status": "failed", "error": "Tool execution failed"})
+    if status != JobStatus.FINISHED:
+        return json_response({"ok": True, "status": "running"})
+
+    # only the first poll that sees the finished job answers it
+    if not redis_client.delete(f"turn:{job_id}"):
+        return json_response({"ok": False, "error": "Unknown job"}, 404)
+
+    messages = [SYSTEM_MSG, *turn["messages"]]
+    map_updated = append_tool_results(messages, turn["calls"], job.return_value())
+    assistant_text = await followup_reply(messages)
+
+    session["messages"].append({"role": "assistant", "content": assistant_text})
+    trim_history()
+
+    resp = {
+        "ok": True,
+        "status": "done",
+        "reply": assistant_text,
+        "messages": session["messages"],
+    }
+    if map_updated:
+        resp["map"] = current_map_payload()
+    return Response(json_stream(resp), mimetype="application/json")
 
 
 @app.get("/api/history")
 def api_history():
     ensure_state()
-    return jsonify({"ok": True, "messages": session["messages"]})
+
+    # The history only changes on chat turns, so polls are answered with a
+    # 304 when the client already has this version.
+    messages = orjson.dumps(session["messages"])
+    etag = hashlib.sha1(messages).hexdigest()
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    resp = Response(b'{"ok":true,"messages":' + messages + b"}", mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 
 
@@ -290,8 +956,13 @@ def api_reset():
     """
     session.clear()
     ensure_state()
-    return jsonify({"ok": True})
+    return json_response({"ok": True})
 
 
 if __name__ == "__main__":
-    app.run( port=8000, debug=True)
+    from hypercorn.config import Config
+    from hypercorn.run import run
+
+    config = Config.from_toml(os.path.join(app.root_path, "hypercorn.toml"))
+    config.application_path = "app:app"
+    run(config)
@@ -73,6 +73,7 @@ function addMessage(role, text) {
   wrapper.appendChild(bubble);
   chatMessages.appendChild(wrapper);
   chatMessages.scrollTop = chatMessages.scrollHeight;
+  return bubble;
 }
 
 function setChatLoading(isLoading) {
@@ -171,13 +172,17 @@ async function applyBackendMap(mapPayload) {
 
     // -----------------------
     // GeoJSON URL (exported file)
-    // { type:"geojson_url", url:"/generated/xxx.geojson" }
+    // { type:"geojson_url", url:"/generated/xxx.geojson", geojson?:{...} }
+    // Small layers arrive with the FeatureCollection inline; no fetch needed.
     // -----------------------
     if (layer.type === "geojson_url" && layer.url) {
       try {
-        const res = await fetch(layer.url, { cache: "no-store" });
-        if (!res.ok) throw new Error(`HTTP ${res.status}`);
-        const gj = await res.json();
+        let gj = layer.geojson;
+        if (!gj) {
+          const res = await fetch(layer.url); // content-addressed, cached as immutable
+          if (!res.ok) throw new Error(`HTTP ${res.status}`);
+          gj = await res.json();
+        }
 
         const features = new ol.format.GeoJSON().readFeatures(gj, {
           dataProjection: "EPSG:4326",
@@ -189,6 +194,49 @@ async function applyBackendMap(mapPayload) {
         console.error("Failed to load geojson_url:", layer.url, err);
       }
     }
+
+    // -----------------------
+    // GeoJSONSeq URL (large exports, one Feature per line)
+    // { type:"geojsonseq_url", url:"/output/xxx.geojsonl" }
+    // Features are drawn as lines arrive instead of after the full download.
+    // -----------------------
+    if (layer.type === "geojsonseq_url" && layer.url) {
+      try {
+        const res = await fetch(layer.url);
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+
+        const format = new ol.format.GeoJSON();
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+
+        const addLines = (lines) => {
+          const features = [];
+          for (const line of lines) {
+            if (!line.trim()) continue;
+            const f = format.readFeature(JSON.parse(line), {
+              dataProjection: "EPSG:4326",
+              featureProjection: map.getView().getProjection(),
+            });
+            f.set("layerName", layer.name || "Unknown");
+            features.push(f);
+          }
+          backendSource.addFeatures(features);
+        };
+
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split("\n");
+          buffer = lines.pop(); // keep the incomplete last line
+          addLines(lines);
+        }
+        addLines([buffer]);
+      } catch (err) {
+        console.error("Failed to load geojsonseq_url:", layer.url, err);
+      }
+    }
   }
 }
 
@@ -212,6 +260,100 @@ function getDrawGeoJSON() {
 
 
 
+// Read the SSE stream from /api/chat:
+//   map   -> draw the tool result layers
+//   delta -> grow the assistant bubble as tokens arrive
+//   job   -> tools run in the background; poll for the answer
+//   error -> show the error
+async function consumeChatStream(res) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let text = "";
+  let bubble = null;
+  let jobId = null;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let sep;
+    while ((sep = buffer.indexOf("\n\n")) !== -1) {
+      const block = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+      }
+      const payload = data ? JSON.parse(data) : {};
+
+      if (event === "map") {
+        applyBackendMap(payload);
+      } else if (event === "delta") {
+        if (!bubble) {
+          removeLoader();
+          bubble = addMessage("assistant", "");
+        }
+        text += payload.content || "";
+        bubble.innerHTML = DOMPurify.sanitize(marked.parse(text));
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+      } else if (event === "job") {
+        jobId = payload.job_id;
+      } else if (event === "error") {
+        removeLoader();
+        addMessage("assistant", "❌ " + (payload.error || "Server error"));
+      }
+    }
+  }
+
+  if (jobId) return pollChatJob(jobId);
+  removeLoader();
+}
+
+
+// Large-area queries are answered by a background job: poll until done,
+// or give up after timeoutMs (e.g. when no worker is running).
+async function pollChatJob(jobId, intervalMs = 1000, timeoutMs = 180000) {
+  const deadline = Date.now() + timeoutMs;
+
+  while (Date.now() < deadline) {
+    await new Promise((resolve) => setTimeout(resolve, intervalMs));
+
+    let data;
+    try {
+      const res = await fetch(`/api/chat/status/${jobId}`, { cache: "no-store" });
+      data = await res.json().catch(() => ({}));
+    } catch (err) {
+      continue; // network hiccup: retry until the deadline
+    }
+
+    if (data.ok && data.status === "running") continue;
+
+    showChatReply(data);
+    return;
+  }
+
+  showChatReply({ ok: false, error: "The analysis is taking too long. Please try again later." });
+}
+
+
+// A JSON chat answer (from /api/chat or a finished job).
+function showChatReply(data) {
+  removeLoader();
+  if (!data.ok) {
+    addMessage("assistant", "❌ " + (data.error || "Server error"));
+    return;
+  }
+  if (data.map) applyBackendMap(data.map);
+  addMessage("assistant", data.reply || "");
+}
+
+
+
 function renderMessagesFromServer(msgs) {
   clearChatUI();
   for (const m of msgs || []) {
@@ -241,7 +383,11 @@ chatForm.addEventListener("submit", async (e) => {
   try {
     const res = await fetch("/api/chat", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: {
+        "Content-Type": "application/json",
+        // the server streams only when it can (Redis configured), else JSON
+        "Accept": "text/event-stream, application/json;q=0.9",
+      },
       body: JSON.stringify({
         message: text,
         map_context: {
@@ -250,29 +396,22 @@ chatForm.addEventListener("submit", async (e) => {
       }),
     });
 
-    const data = await res.json();
-    console.log("data",data)
-    console.log("data.map",data.map)
-
-    removeLoader();
-    setChatLoading(false);
-
-    if (!res.ok || !data.ok) {
+    if (!res.ok) {
+      const data = await res.json().catch(() => ({}));
+      removeLoader();
+      setChatLoading(false);
       addMessage("assistant", "❌ " + (data.error || "Server error"));
       return;
     }
 
-    // addMessage("assistant", data.reply);
-
-    renderMessagesFromServer(data.messages);
-
-
-    if (data.map) {
-      applyBackendMap(data.map);
+    if ((res.headers.get("Content-Type") || "").startsWith("text/event-stream")) {
+      await consumeChatStream(res);
+    } else {
+      const data = await res.json().catch(() => ({}));
+      if (data.ok && data.status === "running") await pollChatJob(data.job_id);
+      else showChatReply(data);
     }
-
-
-
+    setChatLoading(false);
 
   } catch (err) {
     console.error(err);
@@ -15,6 +15,10 @@ from unittest.mock import patch
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, PROJECT_ROOT)
 
+# No background warmup: the data tests load the buildings themselves
+# (warm_buildings), so loading stays deterministic.
+os.environ["WARMUP_ON_START"] = "0"
+
 from app import app, DEFAULT_MAP_CENTER, DEFAULT_MAP_ZOOM, apply_map_from_tool_result
 from flask import session as flask_session
 
@@ -40,6 +44,14 @@ def client():
         yield c
 
 
+@pytest.fixture(scope="session")
+def warm_buildings():
+    """Load the buildings and build their STRtree once for all data tests."""
+    from tools.buildings_analysis import warmup
+
+    warmup()
+
+
 @pytest.fixture
 def clean_output_dir():
     """Ensure output dir exists + clean it after the test."""
@@ -76,7 +88,7 @@ def test_session_initialized_on_homepage(client):
         assert "map_layers" in sess
 
         assert sess["messages"] == []
-        assert sess["map_center"] == DEFAULT_MAP_CENTER
+        assert sess["map_center"] == list(DEFAULT_MAP_CENTER)
         assert sess["map_zoom"] == DEFAULT_MAP_ZOOM
         assert sess["map_layers"] == []
 
@@ -96,7 +108,7 @@ def test_apply_map_from_tool_result_updates_session():
 
     with app.test_request_context("/"):
         # initialize defaults in session
-        flask_session["map_center"] = DEFAULT_MAP_CENTER
+        flask_session["map_center"] = list(DEFAULT_MAP_CENTER)
         flask_session["map_zoom"] = DEFAULT_MAP_ZOOM
         flask_session["map_layers"] = []
 
@@ -158,7 +170,7 @@ def test_api_reset_clears_session(client):
 
     with client.session_transaction() as sess:
         assert sess["messages"] == []
-        assert sess["map_center"] == DEFAULT_MAP_CENTER
+        assert sess["map_center"] == list(DEFAULT_MAP_CENTER)
         assert sess["map_zoom"] == DEFAULT_MAP_ZOOM
         assert sess["map_layers"] == []
 
@@ -198,7 +210,7 @@ def test_buffer_point_validation_and_output(clean_output_dir):
     reason="Building dataset not found: static/data/utrecht_pand_clip.gpkg",
 )
 
-def test_buildings_within_buffer_data(clean_output_dir):
+def test_buildings_within_buffer_data(warm_buildings, clean_output_dir):
     # Utrecht center (should be inside boundary)
     lat, lon = 52.0907, 5.1214
 
@@ -225,7 +237,7 @@ def test_buildings_within_buffer_data(clean_output_dir):
     not os.path.exists(DATASET_PATH),
     reason="Building dataset not found: static/data/utrecht_pand_clip.gpkg",
 )
-def test_buildings_higher_than_within_buffer_data(clean_output_dir):
+def test_buildings_higher_than_within_buffer_data(warm_buildings, clean_output_dir):
     from tools.buildings_analysis import buildings_higher_than_within_buffer
 
     lat, lon = 52.0907, 5.1214  # Utrecht center
@@ -251,7 +263,7 @@ def test_buildings_higher_than_within_buffer_data(clean_output_dir):
     not os.path.exists(DATASET_PATH),
     reason="Building dataset not found: static/data/utrecht_pand_clip.gpkg",
 )
-def test_height_stats_within_buffer_data(clean_output_dir):
+def test_height_stats_within_buffer_data(warm_buildings, clean_output_dir):
     from tools.buildings_analysis import height_stats_within_buffer
 
     lat, lon = 52.0907, 5.1214
@@ -273,7 +285,7 @@ def test_height_stats_within_buffer_data(clean_output_dir):
     not os.path.exists(DATASET_PATH),
     reason="Building dataset not found: static/data/utrecht_pand_clip.gpkg",
 )
-def test_tallest_building_within_buffer_data(clean_output_dir):
+def test_tallest_building_within_buffer_data(warm_buildings, clean_output_dir):
     from tools.buildings_analysis import tallest_building_within_buffer
 
     lat, lon = 52.0907, 5.1214
@@ -287,4 +299,449 @@ def test_tallest_building_within_buffer_data(clean_output_dir):
         t = result["tallest"]
         assert "height_m" in t
         assert isinstance(t["height_m"], (int, float))
-        assert t["height_m"] >= 0
\ No newline at end of file
+        assert t["height_m"] >= 0
+
+# ============================================================
+# 9) Tool results are cached when Redis is available
+# ============================================================
+class _DictRedis:
+    """Minimal stand-in for the two Redis calls used by cached_tool."""
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def setex(self, key, ttl, value):
+        self.store[key] = value
+
+
+def test_call_tool_uses_redis_cache():
+    fake = _DictRedis()
+    with patch("tools.tool_registry._get_redis", return_value=fake), \
+         patch("tools.functions.geocode_place", return_value=(52.3676, 4.9041)) as mock_geocode:
+        first = call_tool("geocode_location", {"place": "amsterdam"})
+        second = call_tool("geocode_location", {"place": "amsterdam"})
+
+    assert first == second
+    assert mock_geocode.call_count == 1
+    assert len(fake.store) == 1
+
+
+# ============================================================
+# 10) Chat history is trimmed to the configured window
+# ============================================================
+def test_trim_history_keeps_recent_messages():
+    from app import trim_history, MAX_HISTORY_MESSAGES
+
+    with app.test_request_context("/"):
+        flask_session["messages"] = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"}
+            for i in range(MAX_HISTORY_MESSAGES + 4)
+        ]
+        trim_history()
+
+        assert len(flask_session["messages"]) == MAX_HISTORY_MESSAGES
+        assert flask_session["messages"][-1]["content"] == f"message {MAX_HISTORY_MESSAGES + 3}"
+        assert "history_rollup" not in flask_session
+
+
+# ============================================================
+# 11) OpenAI calls are retried on transient errors
+# ============================================================
+def test_create_completion_retries_transient_errors():
+    import asyncio
+    import openai
+    from unittest.mock import AsyncMock, MagicMock
+    from tenacity import wait_none
+    from app import create_completion
+
+    err = openai.APITimeoutError(request=MagicMock())
+    create = AsyncMock(side_effect=[err, err, "completion"])
+
+    with patch("app.client.chat.completions.create", create):
+        result = asyncio.run(create_completion.retry_with(wait=wait_none())(model="x"))
+
+    assert result == "completion"
+    assert create.call_count == 3
+
+
+# ============================================================
+# 12) Intent routing: off-topic skips OpenAI, clear queries force a tool
+# ============================================================
+def test_route_intent():
+    from app import route_intent
+
+    point = '{"type":"Point","coordinates":[5.1214,52.0907]}'
+
+    assert route_intent("What will interest rates do next year?") == (False, None)
+    assert route_intent("Tell me a joke") == (False, None)
+    # building questions without a keyword like "building" still reach the model
+    assert route_intent("How tall is the Dom tower?") == (True, None)
+    assert route_intent("How many houses are near the Dom?") == (True, None)
+    assert route_intent("Hoe hoog is de Domtoren?") == (True, None)
+    assert route_intent("Hoeveel woningen staan binnen 300 m?") == (True, None)
+    # place-only requests for geocode_location / buffer_location
+    for text in [
+        "Zoom to Groningen", "Take me to Leiden", "Toon Maastricht",
+        "Ga naar Eindhoven", "Geocode Den Haag", "Draw a 500 m circle around Delft",
+    ]:
+        assert route_intent(text) == (True, None), text
+    assert route_intent("Show Utrecht Maliebaan on the map") == (True, None)
+    assert route_intent(f"Which is the tallest building within 300 meters? {point}") == (
+        True, "tallest_building_within_buffer",
+    )
+    assert route_intent(f"Show buildings higher than 5 meters within 300 meters {point}") == (
+        True, "buildings_higher_than_within_buffer",
+    )
+    # two different tools asked for: no forced tool, the model may call both
+    assert route_intent(
+        "How many buildings higher than 20 m within 300 m of 52.09, 5.12 and what is the tallest?"
+    ) == (True, None)
+    assert route_intent(f"Show buildings within 300 meters {point}") == (True, "buildings_within_buffer")
+    # several metrics at once: one analyze_buffer call, not one single-metric tool
+    assert route_intent("What is the tallest building and total volume within 500 m of 52.09, 5.12?") == (
+        True, "analyze_buffer",
+    )
+    assert route_intent("Height stats, footprint and volume within 300m of 52.0907, 5.1214") == (
+        True, "analyze_buffer",
+    )
+
+
+def test_api_chat_off_topic_skips_openai(client):
+    with patch("app.create_completion") as mock_create:
+        res = client.post("/api/chat", json={"message": "Tell me a joke"})
+
+    assert res.status_code == 200
+    assert res.get_json()["ok"] is True
+    mock_create.assert_not_called()
+
+
+# ============================================================
+# 13) /api/history answers repeat polls with 304
+# ============================================================
+def test_api_history_etag(client):
+    with client.session_transaction() as sess:
+        sess["messages"] = [{"role": "user", "content": "hi"}]
+
+    res = client.get("/api/history")
+    assert res.status_code == 200
+    assert res.get_json()["messages"] == [{"role": "user", "content": "hi"}]
+
+    etag = res.headers["ETag"]
+    res = client.get("/api/history", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+
+
+# ============================================================
+# 14) Large-radius tool calls run as a background job
+# ============================================================
+def _completion(message: dict):
+    from openai.types.chat import ChatCompletion
+
+    return ChatCompletion.model_validate({
+        "id": "cmpl", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", **message}}],
+    })
+
+
+def test_long_tool_call_runs_as_background_job(client):
+    fakeredis = pytest.importorskip("fakeredis")
+    from unittest.mock import AsyncMock
+    from rq import Queue
+    from tools.tool_registry import TOOL_REGISTRY
+
+    fake = fakeredis.FakeRedis()
+    tool_call = {
+        "id": "call_1", "type": "function",
+        "function": {"name": "buildings_within_buffer", "arguments": '{"lat": 52.09, "lon": 5.12, "radius_m": 2000}'},
+    }
+    create = AsyncMock(side_effect=[
+        _completion({"content": None, "tool_calls": [tool_call]}),
+        _completion({"content": "There are 3 buildings."}),
+    ])
+
+    with patch("app.redis_client", fake), \
+         patch("app.rq_queue", Queue("tools", connection=fake, is_async=False)), \
+         patch("app.create_completion", create), \
+         patch.dict(TOOL_REGISTRY, {"buildings_within_buffer": lambda **kw: {"ok": True, "count": 3}}):
+        res = client.post("/api/chat", json={"message": "Show buildings within 2000 meters"})
+        data = res.get_json()
+        assert data["status"] == "running"
+
+        res = client.get(f"/api/chat/status/{data['job_id']}")
+        data = res.get_json()
+
+    assert data["ok"] is True
+    assert data["status"] == "done"
+    assert data["reply"] == "There are 3 buildings."
+    assert data["messages"][-1] == {"role": "assistant", "content": "There are 3 buildings."}
+
+
+# ============================================================
+# 15) Content-addressed exports are served as immutable
+# ============================================================
+def test_serve_generated_immutable(client, clean_output_dir):
+    r = buffer_point(lat=52.09, lon=5.12, radius_m=500)
+    url = next(l["url"] for l in r["map"]["layers"] if l.get("type") == "geojson_url")
+
+    res = client.get(url)
+    assert res.status_code == 200
+    assert "immutable" in res.headers["Cache-Control"]
+
+
+# ============================================================
+# 16) Small layers travel inline, but not into session or model
+# ============================================================
+def test_inline_geojson_kept_out_of_session():
+    from app import current_map_payload, _for_model
+
+    fc = {"type": "FeatureCollection", "features": []}
+    tool_result = {
+        "ok": True,
+        "map": {"layers": [{"type": "geojson_url", "url": "/output/b_0123456789abcdef.geojson", "geojson": fc}]},
+    }
+
+    with app.test_request_context("/"):
+        flask_session["map_center"] = list(DEFAULT_MAP_CENTER)
+        flask_session["map_zoom"] = DEFAULT_MAP_ZOOM
+
+        assert apply_map_from_tool_result(tool_result) is True
+        assert "geojson" not in flask_session["map_layers"][0]
+        assert current_map_payload()["layers"][0]["geojson"] == fc
+
+    assert "geojson" not in _for_model(tool_result)["map"]["layers"][0]
+
+
+# ============================================================
+# 17) Buffer queries match a plain STRtree dwithin query
+# ============================================================
+@pytest.mark.skipif(
+    not os.path.exists(DATASET_PATH),
+    reason="Building dataset not found: static/data/utrecht_pand_clip.gpkg",
+)
+def test_query_buffer_covering_dataset(warm_buildings):
+    import numpy as np
+    from tools.buildings_analysis import _query_buffer, _to_rd_point, load_buildings
+
+    gdf = load_buildings()
+    pt_rd = _to_rd_point(52.0907, 5.1214)
+
+    for radius_m in (100, 1000, 15000):
+        hits = _query_buffer(gdf, pt_rd, radius_m)
+        expected = np.sort(gdf.sindex.query(pt_rd, predicate="dwithin", distance=float(radius_m)))
+        assert np.array_equal(hits, expected)
+
+
+# ============================================================
+# 18) Geocoding results (and misses) are cached on disk
+# ============================================================
+def test_geocode_place_uses_disk_cache(tmp_path):
+    import diskcache
+    from types import SimpleNamespace
+    from tools import functions
+
+    with patch("tools.functions._geocode_cache", diskcache.Cache(str(tmp_path))), \
+         patch("tools.functions.geocode") as mock_geocode:
+        mock_geocode.side_effect = lambda place, **kw: (
+            SimpleNamespace(latitude=52.09, longitude=5.12) if place == "Utrecht" else None
+        )
+
+        assert functions.geocode_place("Utrecht") == (52.09, 5.12)
+        assert functions.geocode_place(" utrecht ") == (52.09, 5.12)
+        assert functions.geocode_place("Nowhere") is None
+        assert functions.geocode_place("Nowhere") is None
+
+    assert mock_geocode.call_count == 2
+
+
+def test_geocode_place_does_not_cache_outages(tmp_path):
+    import diskcache
+    from types import SimpleNamespace
+    from geopy.exc import GeocoderTimedOut
+    from tools import functions
+
+    with patch("tools.functions._geocode_cache", diskcache.Cache(str(tmp_path))), \
+         patch("tools.functions.geocode") as mock_geocode:
+        mock_geocode.side_effect = GeocoderTimedOut("timed out")
+        assert functions.geocode_place("Leiden") is None
+
+        mock_geocode.side_effect = None
+        mock_geocode.return_value = SimpleNamespace(latitude=52.16, longitude=4.49)
+        assert functions.geocode_place("Leiden") == (52.16, 4.49)
+
+
+# ============================================================
+# 19) analyze_buffer matches the single-purpose tools
+# ============================================================
+@pytest.mark.skipif(
+    not os.path.exists(DATASET_PATH),
+    reason="Building dataset not found: static/data/utrecht_pand_clip.gpkg",
+)
+def test_analyze_buffer_data(warm_buildings, clean_output_dir):
+    from tools.buildings_analysis import (
+        analyze_buffer,
+        footprint_stats_within_buffer,
+        height_stats_within_buffer,
+        tallest_building_within_buffer,
+        total_volume_within_buffer,
+    )
+
+    query = dict(lat=52.0907, lon=5.1214, radius_m=200)
+    result = analyze_buffer(**query)
+
+    assert result["ok"] is True
+    assert result["count"] > 0
+    assert result["height_stats"] == pytest.approx(height_stats_within_buffer(**query)["stats"])
+    assert result["tallest"] == tallest_building_within_buffer(**query)["tallest"]
+    assert result["footprint_stats"] == pytest.approx(footprint_stats_within_buffer(**query)["stats"])
+    assert result["volume_stats"] == pytest.approx(total_volume_within_buffer(**query)["stats"])
+
+
+# ============================================================
+# 20) batch point-in-Utrecht matches the scalar check
+# ============================================================
+def test_are_points_in_utrecht_matches_scalar():
+    from tools.buildings_analysis import are_points_in_utrecht, is_point_in_utrecht
+
+    lats = [52.0907, 52.3676, 52.06, 51.0]
+    lons = [5.1214, 4.9041, 5.16, 5.12]
+    batch = are_points_in_utrecht(lats, lons)
+
+    assert batch.tolist() == [is_point_in_utrecht(la, lo) for la, lo in zip(lats, lons)]
+    assert batch[0] and not batch[1]
+
+
+# ============================================================
+# 21) exports recreate a missing output directory
+# ============================================================
+def test_export_creates_output_dir(tmp_path):
+    from tools import functions
+
+    out_dir = tmp_path / "output"
+    with patch("tools.functions.OUTPUT_DIR", str(out_dir)):
+        fname = functions._write_output_file(b"{}", "probe", "geojson")
+
+    assert (out_dir / fname).read_bytes() == b"{}"
+    assert (out_dir / f"{fname}.gz").exists()
+
+
+# ============================================================
+# 22) Streamed replies: JSON without Redis, no partial reply on errors
+# ============================================================
+def test_api_chat_streams_only_with_redis(client):
+    from unittest.mock import AsyncMock
+
+    phase = AsyncMock(return_value=([], "Hello", False, None))
+    with patch("app.redis_client", None), patch("app.run_tool_phase", phase):
+        res = client.post("/api/chat", json={"message": "Show Utrecht"}, headers={"Accept": "text/event-stream"})
+
+    assert res.mimetype == "application/json"
+    assert res.get_json()["reply"] == "Hello"
+
+
+def test_failed_stream_keeps_no_partial_reply(client):
+    fakeredis = pytest.importorskip("fakeredis")
+    from unittest.mock import AsyncMock
+
+    def broken_stream(messages):
+        yield "Half an"
+        raise RuntimeError("connection lost")
+
+    phase = AsyncMock(return_value=([], None, False, None))
+    with patch("app.redis_client", fakeredis.FakeRedis()), \
+         patch("app.run_tool_phase", phase), \
+         patch("app.stream_followup", broken_stream):
+        res = client.post("/api/chat", json={"message": "Show Utrecht"}, headers={"Accept": "text/event-stream"})
+        body = res.get_data(as_text=True)
+        history = client.get("/api/history").get_json()["messages"]
+
+        with client.session_transaction() as sess:
+            assert "pending_reply" not in sess
+
+    assert "event: error" in body
+    assert "event: done" not in body
+    assert history == [{"role": "user", "content": "Show Utrecht"}]
+
+
+# ============================================================
+# 23) Job status: expired and canceled jobs end the poll
+# ============================================================
+def test_chat_status_expired_and_canceled_jobs(client):
+    fakeredis = pytest.importorskip("fakeredis")
+    import orjson
+    from rq import Queue
+
+    fake = fakeredis.FakeRedis()
+    job = Queue("tools", connection=fake).enqueue("tools.tool_registry.call_tools", [])
+    job.cancel()
+    fake.set("turn:canceled", orjson.dumps({"job_id": job.id, "messages": [], "calls": []}))
+    fake.set("turn:expired", orjson.dumps({"job_id": "gone", "messages": [], "calls": []}))
+
+    with patch("app.redis_client", fake):
+        canceled = client.get("/api/chat/status/canceled")
+        expired = client.get("/api/chat/status/expired")
+
+    assert canceled.get_json()["status"] == "failed"
+    assert expired.status_code == 404
+    assert expired.get_json()["status"] == "failed"
+    assert not fake.exists("turn:canceled", "turn:expired")
+
+
+# ============================================================
+# 24) Buffer circles are centred on the exact query point
+# ============================================================
+def test_export_buffer_file_centred_on_point(clean_output_dir):
+    import shapely
+    from tools.functions import export_buffer_file
+
+    lat, lon = 52.0907123, 5.1214567
+    fname = export_buffer_file(lat, lon, 300)
+    assert export_buffer_file(lat, lon, 300) == fname
+
+    with open(os.path.join(clean_output_dir, fname)) as f:
+        circle = shapely.from_geojson(json.dumps(json.load(f)["features"][0]["geometry"]))
+
+    assert circle.centroid.x == pytest.approx(lon, abs=1e-6)
+    assert circle.centroid.y == pytest.approx(lat, abs=1e-6)
+
+
+# ============================================================
+# 25) A corrupt buildings cache is rebuilt, not fatal
+# ============================================================
+@pytest.mark.skipif(
+    not os.path.exists(DATASET_PATH),
+    reason="Building dataset not found: static/data/utrecht_pand_clip.gpkg",
+)
+def test_corrupt_buildings_cache_is_ignored(tmp_path):
+    from tools import buildings_analysis
+
+    cache = tmp_path / "corrupt.feather"
+    cache.write_bytes(b"not an arrow file")
+
+    with patch.object(buildings_analysis, "BUILDING_CACHE_PATH", str(cache)), \
+         patch.object(buildings_analysis, "BUILDING_GPKG_PATH", DATASET_PATH):
+        assert buildings_analysis._read_buildings_cache() is None
+
+
+# ============================================================
+# 26) Old content-addressed exports are swept on write
+# ============================================================
+def test_old_exports_are_swept(tmp_path):
+    from tools import functions
+
+    old = tmp_path / "filtered_buildings_0123456789abcdef.geojson"
+    old_gz = tmp_path / "filtered_buildings_0123456789abcdef.geojson.gz"
+    keep = tmp_path / "buffer_geom.geojson"
+    for f in (old, old_gz, keep):
+        f.write_bytes(b"{}")
+        os.utime(f, (0, 0))
+
+    with patch.object(functions, "OUTPUT_DIR", str(tmp_path)), \
+         patch.object(functions, "_last_output_sweep", 0.0):
+        fname = functions._write_output_file(b'{"new":1}', "probe", "geojson")
+
+    assert not old.exists() and not old_gz.exists()
+    assert keep.exists()
+    assert (tmp_path / fname).exists()
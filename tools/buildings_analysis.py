@@ -1,16 +1,35 @@
+import glob
+import hashlib
+import logging
 import os
+import threading
+import uuid
 from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
 from shapely.geometry import Point
 from pyproj import Transformer
 import json
 
 from tools.functions import (
-    export_gpd_to_geojson_file
+    export_buffer_file,
+    export_gpd_to_geojson_file,
+    export_gpd_to_geojsonseq_file,
+    export_gpd_to_inline_geojson,
+    export_geometry_to_geojson_file,
+    geojson_url_layer,
+    marker_layer,
+    rd_to_wgs84_geometries,
+    WGS84_GEOMETRY_COL,
 )
 
+logger = logging.getLogger(__name__)
+
 # -----------------------------
 # Configure your dataset path
 # -----------------------------
@@ -22,6 +41,13 @@ UTRECHT_BOUNDARY_PATH = "static/data/utrecht.geojson"
 BUILDING_DEFAULT_CENTER = (52.0907, 5.1214)  # (lat, lon)
 
 MAX_EXPORT_FEATURES = 5000     # hard cap features sent to frontend
+GEOJSONSEQ_MIN_FEATURES = 1000  # larger building layers are streamed as GeoJSONSeq
+GEOJSON_INLINE_MAX_FEATURES = 200  # smaller layers also travel inline with the reply
+# attributes exported with building layers; the raw b3_* columns stay server-side
+EXPORT_COLUMNS = ["identificatie", "height_m", "footprint_m2", "volume_m3"]
+# Douglas-Peucker tolerance (m, RD) for the exported map geometry only;
+# analysis always runs on the full RD footprints
+SIMPLIFY_TOL_M = 0.5
 
 
 OUTPUT_DIR = "output"         
@@ -31,30 +57,62 @@ FOOTPRINT_COL = "b3_opp_grond"      # Total ground floor area. Unit: square metr
 
 
 _RD_TO_WGS84 = Transformer.from_crs("EPSG:28992", "EPSG:4326", always_xy=True)
+_WGS84_TO_RD = Transformer.from_crs("EPSG:4326", "EPSG:28992", always_xy=True)
 
 
 VOLUME_COLS = ["b3_volume_lod22", "b3_volume_lod13", "b3_volume_lod12"]  # m³
 
+# Attributes kept on the cached frame once the derived columns exist; other
+# 3DBAG attributes (raw footprint/volume, status, ...) are dropped at load.
+CACHED_COLUMNS = ["identificatie", HEIGHT_TOP_COL, HEIGHT_GROUND_COL, "height_m", "footprint_m2", "volume_m3"]
 
+# Columnar copy of the processed layer (incl. derived columns), rebuilt
+# whenever the GeoPackage is newer; memory-mapped so workers share it.
+# The file name carries a key of everything that shapes its contents, so
+# changing the columns or the simplify tolerance starts a new cache; bump
+# BUILDING_CACHE_VERSION when the processing itself changes.
+BUILDING_CACHE_VERSION = 1
+_CACHE_KEY = hashlib.sha1(
+    repr((BUILDING_CACHE_VERSION, SIMPLIFY_TOL_M, CACHED_COLUMNS, WGS84_GEOMETRY_COL)).encode()
+).hexdigest()[:8]
+BUILDING_CACHE_PATH = f"static/data/utrecht_pand_clip.{_CACHE_KEY}.feather"
 
 
-@lru_cache(maxsize=1)
-def load_buildings() -> Tuple[gpd.GeoDataFrame, Optional[str]]:
+
+
+# lru_cache doesn't serialize the first call: without the lock, the startup
+# warmup and the first tool calls (worker threads) would each load the data
+_LOAD_LOCK = threading.Lock()
+
+
+def load_buildings() -> gpd.GeoDataFrame:
     """
     Load buildings once and cache in memory.
     Ensures CRS is EPSG:28992 (RD New) for distance in meters.
     """
+    with _LOAD_LOCK:
+        return _load_buildings()
+
+
+@lru_cache(maxsize=1)
+def _load_buildings() -> gpd.GeoDataFrame:
     if not os.path.exists(BUILDING_GPKG_PATH):
         raise FileNotFoundError(f"BUILDING_GPKG_PATH not found: {BUILDING_GPKG_PATH}")
 
-    if BUILDING_LAYER_NAME:
-        gdf = gpd.read_file(BUILDING_GPKG_PATH, layer=BUILDING_LAYER_NAME)
-    else:
+    cached = _read_buildings_cache()
+    if cached is not None:
+        return _slim(cached)
+
+    layer = BUILDING_LAYER_NAME
+    if not layer:
         # Auto pick the first layer
-        layers = gpd.io.file.fiona.listlayers(BUILDING_GPKG_PATH)
-        if not layers:
+        layers = pyogrio.list_layers(BUILDING_GPKG_PATH)
+        if len(layers) == 0:
             raise ValueError("No layers found in GeoPackage.")
-        gdf = gpd.read_file(BUILDING_GPKG_PATH, layer=layers[0])
+        layer = layers[0][0]
+
+    # pyogrio + Arrow reads the whole layer in one bulk OGR call
+    gdf = gpd.read_file(BUILDING_GPKG_PATH, layer=layer, engine="pyogrio", use_arrow=True)
 
     if gdf.empty:
         raise ValueError("Buildings layer loaded but is empty.")
@@ -67,30 +125,154 @@ def load_buildings() -> Tuple[gpd.GeoDataFrame, Optional[str]]:
         gdf = gdf.to_crs(epsg=28992)
 
     # Ensure valid geometries
-    gdf = gdf[gdf.geometry.notna()].copy()
+    gdf = _slim(_add_derived_columns(_compact_dtypes(gdf[gdf.geometry.notna()])))
+
+    _write_buildings_cache(gdf)
 
     # Build spatial index implicitly by geopandas when needed (rtree/pygeos)
     return gdf
 
 
+def _slim(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    cols = [c for c in [*CACHED_COLUMNS, WGS84_GEOMETRY_COL] if c in gdf.columns]
+    return gdf[cols + [gdf.geometry.name]]
+
+
+def _compact_dtypes(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Shrink the cached frame: 3DBAG measurements as float32, repetitive text
+    columns (e.g. status) as category. Unique ids stay strings.
+    """
+    numeric = [c for c in [HEIGHT_TOP_COL, HEIGHT_GROUND_COL, FOOTPRINT_COL, *VOLUME_COLS] if c in gdf.columns]
+    dtypes = {c: "float32" for c in numeric}
+
+    for c in gdf.columns:
+        if c != gdf.geometry.name and c not in dtypes and pd.api.types.is_string_dtype(gdf[c].dtype):
+            if gdf[c].nunique() <= 0.5 * len(gdf):
+                dtypes[c] = "category"
+
+    return gdf.astype(dtypes)
+
+
+def _read_buildings_cache() -> Optional[gpd.GeoDataFrame]:
+    """
+    Return the Feather cache if it is at least as new as the GeoPackage.
+    The file is memory-mapped and its columns are not consolidated, so the
+    attribute arrays point into the OS page cache, shared by every worker
+    process; only the geometries are decoded per process.
+    """
+    try:
+        if os.path.getmtime(BUILDING_CACHE_PATH) >= os.path.getmtime(BUILDING_GPKG_PATH):
+            return gpd.read_feather(
+                BUILDING_CACHE_PATH, memory_map=True, to_pandas_kwargs={"split_blocks": True}
+            )
+    except (OSError, ImportError):
+        pass  # no cache yet, or pyarrow not installed
+    except Exception:
+        # e.g. ArrowInvalid on a truncated file: rebuild it from the GeoPackage
+        logger.warning("Ignoring unreadable buildings cache %s", BUILDING_CACHE_PATH, exc_info=True)
+    return None
+
+
+def _write_buildings_cache(gdf: gpd.GeoDataFrame) -> None:
+    # temp file + rename, so a worker starting in parallel never reads half a file
+    tmp_path = f"{BUILDING_CACHE_PATH}.{uuid.uuid4().hex}.tmp"
+    try:
+        gdf.to_feather(tmp_path, compression="uncompressed")  # mappable as-is
+        os.replace(tmp_path, BUILDING_CACHE_PATH)
+        # caches built with other settings are never read again
+        for stale in glob.glob(f"{os.path.splitext(BUILDING_GPKG_PATH)[0]}.*feather"):
+            if stale != BUILDING_CACHE_PATH:
+                os.unlink(stale)
+    except (OSError, ImportError):
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def warmup() -> None:
+    """
+    Load the buildings, build their spatial index and load the Utrecht
+    boundary, so the first tool call doesn't pay for it.
+    """
+    gdf = load_buildings()
+    gdf.sindex  # built lazily by geopandas on first access
+    _load_utrecht_boundary_union()
+
+
+def _query_buffer(gdf: gpd.GeoDataFrame, pt_rd: Point, radius_m: float) -> np.ndarray:
+    """
+    Positional indices of the rows within radius_m of pt_rd, in dataset order.
+    An exact distance test inside the STRtree query; the buffer polygon is
+    only needed for the map export.
+    """
+    if gdf is not load_buildings():
+        return np.sort(gdf.sindex.query(pt_rd, predicate="dwithin", distance=float(radius_m)))
+    if _covers_dataset(pt_rd, radius_m):
+        return np.arange(len(gdf))
+
+    # bbox candidates from the STRtree; buildings whose whole bbox lies in
+    # the circle are hits without a GEOS call, only the ones crossing the
+    # edge get the exact distance test
+    r = float(radius_m)
+    px, py = pt_rd.x, pt_rd.y
+    cand = gdf.sindex.query(shapely.box(px - r, py - r, px + r, py + r))
+    minx, miny, maxx, maxy = (b[cand] for b in _building_bounds())
+    fx = np.maximum(px - minx, maxx - px)
+    fy = np.maximum(py - miny, maxy - py)
+    inside = fx * fx + fy * fy <= r * r
+
+    edge = cand[~inside]
+    edge = edge[shapely.dwithin(gdf.geometry.values[edge], pt_rd, r)]
+    return np.sort(np.concatenate([cand[inside], edge]))
+
+
+@lru_cache(maxsize=1)
+def _building_bounds() -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Per-building bbox of load_buildings() as four contiguous arrays."""
+    b = shapely.bounds(load_buildings().geometry.to_numpy())
+    return tuple(np.ascontiguousarray(b[:, i]) for i in range(4))
+
+
+@lru_cache(maxsize=1)
+def _dataset_bounds() -> Tuple[float, float, float, float]:
+    return tuple(float(v) for v in load_buildings().total_bounds)
+
+
+def _covers_dataset(pt_rd: Point, radius_m: float) -> bool:
+    """True if the whole dataset bbox lies within radius_m of pt_rd."""
+    minx, miny, maxx, maxy = _dataset_bounds()
+    dx = max(pt_rd.x - minx, maxx - pt_rd.x)
+    dy = max(pt_rd.y - miny, maxy - pt_rd.y)
+    return dx * dx + dy * dy <= float(radius_m) ** 2
+
+
 def _to_rd_point(lat: float, lon: float) -> Point:
     """
     Convert WGS84 lat/lon to EPSG:28992 point.
     """
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:28992", always_xy=True)
-    x, y = transformer.transform(lon, lat)
+    x, y = _WGS84_TO_RD.transform(lon, lat)
     return Point(x, y)
 
 
-def _export_buffer_geom(buf_geom, radius_m: float) -> str:
-    """Export buffer geometry (shapely) as GeoJSON file, returns filename."""
-    buffer_gdf = gpd.GeoDataFrame(
-        [{"name": "buffer", "radius_m": float(radius_m)}],
-        geometry=[buf_geom],
-        crs="EPSG:28992",
-    )
-    # IMPORTANT: make filenames unique to avoid overwriting/caching issues
-    return export_gpd_to_geojson_file(buffer_gdf, f"buffer_geom")
+def _export_buildings_layer(gdf: gpd.GeoDataFrame, name: str) -> Dict[str, Any]:
+    """
+    Export buildings and return the map layer pointing at the file.
+    Large layers are written as GeoJSONSeq so the map can render them
+    feature by feature while downloading; small ones carry the
+    FeatureCollection inline as well, so the map needs no extra fetch.
+    """
+    gdf = gdf[[c for c in [*EXPORT_COLUMNS, WGS84_GEOMETRY_COL] if c in gdf.columns] + [gdf.geometry.name]]
+
+    if len(gdf) < GEOJSON_INLINE_MAX_FEATURES:
+        fname, geojson = export_gpd_to_inline_geojson(gdf, "filtered_buildings")
+        return {**geojson_url_layer(name, fname), "geojson": geojson}
+
+    if len(gdf) >= GEOJSONSEQ_MIN_FEATURES:
+        fname = export_gpd_to_geojsonseq_file(gdf, "filtered_buildings")
+        return {"type": "geojsonseq_url", "name": name, "url": f"/{OUTPUT_DIR}/{fname}"}
+
+    fname = export_gpd_to_geojson_file(gdf, "filtered_buildings")
+    return geojson_url_layer(name, fname)
 
 @lru_cache(maxsize=1)
 def _load_utrecht_boundary_union():
@@ -114,8 +296,33 @@ def _load_utrecht_boundary_union():
     # if gdf.crs.to_epsg() != 4326:
     #     gdf = gdf.to_crs(epsg=4326)
 
-    # Merge all boundary features into one geometry
-    return gdf.geometry.unary_union
+    # Merge all boundary features into one geometry; prepared, so the
+    # covers() check in is_point_in_utrecht uses an indexed point-in-polygon
+    boundary = shapely.unary_union(gdf.geometry.values)
+    shapely.prepare(boundary)
+    return boundary
+
+
+@lru_cache(maxsize=1)
+def _utrecht_bounds() -> Tuple[float, float, float, float]:
+    return _load_utrecht_boundary_union().bounds
+
+
+def are_points_in_utrecht(lats, lons) -> np.ndarray:
+    """
+    Vectorized is_point_in_utrecht: boolean array, one entry per (lat, lon).
+    Only points inside the boundary bbox reach the polygon test.
+    """
+    lats = np.asarray(lats, dtype="float64")
+    lons = np.asarray(lons, dtype="float64")
+
+    minx, miny, maxx, maxy = _utrecht_bounds()
+    inside = (lons >= minx) & (lons <= maxx) & (lats >= miny) & (lats <= maxy)
+    if inside.any():
+        boundary = _load_utrecht_boundary_union()
+        # shapely uses (x,y) = (lon,lat)
+        inside[inside] = shapely.covers(boundary, shapely.points(lons[inside], lats[inside]))
+    return inside
 
 
 def is_point_in_utrecht(lat: float, lon: float) -> bool:
@@ -123,8 +330,15 @@ def is_point_in_utrecht(lat: float, lon: float) -> bool:
     True if the point is inside Utrecht boundary polygon.
     Uses 'covers' so boundary edge counts as inside.
     """
+    lat, lon = float(lat), float(lon)
+
+    # cheap bbox test first: rejects most points outside Utrecht
+    minx, miny, maxx, maxy = _utrecht_bounds()
+    if not (minx <= lon <= maxx and miny <= lat <= maxy):
+        return False
+
     boundary = _load_utrecht_boundary_union()
-    pt = Point(float(lon), float(lat))  # shapely uses (x,y) = (lon,lat)
+    pt = Point(lon, lat)  # shapely uses (x,y) = (lon,lat)
     return boundary.covers(pt)
 
 utrecht_extent_msg="This demo currently supports only Utrecht. Please choose a location within Utrecht."
@@ -156,16 +370,14 @@ def buildings_within_buffer(
     gdf = load_buildings()
 
     pt_rd = _to_rd_point(lat, lon)
-    buf = pt_rd.buffer(radius_m)
 
 
-    buffer_fname = _export_buffer_geom(buf, radius_m)
+    buffer_fname = export_buffer_file(lat, lon, radius_m)
 
 
-    # Fast spatial filter using sindex
-    # 1) bbox prefilter
-    possible_idx = list(gdf.sindex.intersection(buf.bounds))
-    if not possible_idx:
+    # Fast spatial filter: exact distance test inside the STRtree
+    hit_idx = _query_buffer(gdf, pt_rd, radius_m)
+    if len(hit_idx) == 0:
         return {
             "ok": True,
             "count": 0,
@@ -174,24 +386,23 @@ def buildings_within_buffer(
                 "center": [lat, lon],
                 "zoom": 14,
                 "layers": [
-                    {"type": "marker", "lat": lat, "lon": lon, "label": "Selected point"},
-                    { "type": "geojson_url", "name": 'Selected point', "url": f"/{OUTPUT_DIR}/{buffer_fname}" },
+                    marker_layer(lat, lon, "Selected point"),
+                    geojson_url_layer('Selected point', buffer_fname),
                 ],
             },
         }
 
-    candidates = gdf.iloc[possible_idx]
-    hits = candidates[candidates.intersects(buf)].copy()
+    hits = gdf.iloc[hit_idx]
 
     count = int(len(hits))
     export_hits = hits
     truncated = False
     if count > MAX_EXPORT_FEATURES:
-        export_hits = hits.iloc[:MAX_EXPORT_FEATURES].copy()
+        export_hits = hits.iloc[:MAX_EXPORT_FEATURES]
         truncated = True
 
 
-    geojson_filename = export_gpd_to_geojson_file(export_hits, "filtered_buildings")
+    buildings_layer = _export_buildings_layer(export_hits, "Filtered buildings")
 
     
 
@@ -207,9 +418,9 @@ def buildings_within_buffer(
             "center": [lat, lon],
             "zoom": 14,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": 'Selected point'},
-                { "type": "geojson_url", "name": 'Selected point', "url": f"/{OUTPUT_DIR}/{buffer_fname}" },
-                {"type": "geojson_url", "name": "Filtered buildings", "url": f"/{OUTPUT_DIR}/{geojson_filename}"}
+                marker_layer(lat, lon, 'Selected point'),
+                geojson_url_layer('Selected point', buffer_fname),
+                buildings_layer,
             ],
         },
     }
@@ -238,14 +449,13 @@ def buildings_higher_than_within_buffer(
 
     gdf = load_buildings()  # already in EPSG:28992
     pt_rd = _to_rd_point(lat, lon)
-    buf = pt_rd.buffer(radius_m)
-    buffer_fname = _export_buffer_geom(buf, radius_m)
+    buffer_fname = export_buffer_file(lat, lon, radius_m)
 
 
 
 
-    possible_idx = list(gdf.sindex.intersection(buf.bounds))
-    if not possible_idx:
+    hit_idx = _query_buffer(gdf, pt_rd, radius_m)
+    if len(hit_idx) == 0:
         return {
             "ok": True,
             "summary": f"No buildings found within {int(radius_m)}m.",
@@ -253,16 +463,15 @@ def buildings_higher_than_within_buffer(
                 "center": [lat, lon],
                 "zoom": 14,
                 "layers": [
-                    {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                    { "type": "geojson_url", "name": 'Selected point', "url": f"/{OUTPUT_DIR}/{buffer_fname}" },
+                    marker_layer(lat, lon, "Query point"),
+                    geojson_url_layer('Selected point', buffer_fname),
                 ],
             },
         }
 
-    candidates = gdf.iloc[possible_idx]
-    hits = candidates[candidates.intersects(buf)].copy()
+    hits = gdf.iloc[hit_idx]
     count = int(len(hits))
-    # print("total",count)
+    logger.debug("buildings in buffer: %d", count)
     if hits.empty:
         return {
             "ok": True,
@@ -271,41 +480,35 @@ def buildings_higher_than_within_buffer(
                 "center": [lat, lon],
                 "zoom": 14,
                 "layers": [
-                    {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                    { "type": "geojson_url", "name": 'Selected point', "url": f"/{OUTPUT_DIR}/{buffer_fname}" },
+                    marker_layer(lat, lon, "Query point"),
+                    geojson_url_layer('Selected point', buffer_fname),
                 ],
             },
         }
     
 
 
-    # compute height_m
-    if HEIGHT_TOP_COL not in hits.columns:
+    # height_m is precomputed (float32, NaN if invalid) in load_buildings
+    if "height_m" not in hits.columns:
         return {"ok": False, "error": f"Missing column {HEIGHT_TOP_COL} in dataset."}
 
-    if HEIGHT_GROUND_COL in hits.columns:
-        hits["height_m"] = hits[HEIGHT_TOP_COL] - hits[HEIGHT_GROUND_COL]
-    else:
-        # fallback (absolute height)
-        hits["height_m"] = hits[HEIGHT_TOP_COL]
-
-    # drop invalid heights
-    hits = hits[hits["height_m"].notna()]
-    hits = hits[hits["height_m"] >= 0]
-
-    # filter
-    filtered = hits[hits["height_m"] >= float(min_height_m)].copy()
-    total_in_buffer = int(len(hits))
+    # valid heights + threshold in one mask, then a single selection
+    h = hits["height_m"].to_numpy()
+    valid = np.isfinite(h)
+    mask = valid & (h >= float(min_height_m))
+    heights = h[mask]
+    filtered = hits.iloc[np.flatnonzero(mask)]
+    total_in_buffer = int(valid.sum())
     count = int(len(filtered))
-    print("filter_count_wiht_height",count)
+    logger.debug("buildings above %.1f m: %d", float(min_height_m), count)
 
     # stats
     stats = {}
     if count > 0:
         stats = {
-            "min_m": float(filtered["height_m"].min()),
-            "max_m": float(filtered["height_m"].max()),
-            "avg_m": float(filtered["height_m"].mean()),
+            "min_m": float(heights.min()),
+            "max_m": float(heights.max()),
+            "avg_m": float(heights.mean(dtype=np.float64)),
         }
 
     resp = {
@@ -322,8 +525,8 @@ def buildings_higher_than_within_buffer(
             "center": [lat, lon],
             "zoom": 14,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": f"≥{min_height_m}m filter"},
-                { "type": "geojson_url", "name": 'Selected point', "url": f"/{OUTPUT_DIR}/{buffer_fname}" },
+                marker_layer(lat, lon, f"≥{min_height_m}m filter"),
+                geojson_url_layer('Selected point', buffer_fname),
             ],
         },
     }
@@ -341,16 +544,10 @@ def buildings_higher_than_within_buffer(
     export_df = filtered
     truncated = False
     if count > MAX_EXPORT_FEATURES:
-        export_df = filtered.iloc[:MAX_EXPORT_FEATURES].copy()
+        export_df = filtered.iloc[:MAX_EXPORT_FEATURES]
         truncated = True
 
-    geojson_filename = export_gpd_to_geojson_file(export_df, "filtered_buildings")
-
-    resp["map"]["layers"].append({
-        "type": "geojson_url",
-        "name": "Height filtered buildings",
-        "url": f"/{OUTPUT_DIR}/{geojson_filename}",
-    })
+    resp["map"]["layers"].append(_export_buildings_layer(export_df, "Height filtered buildings"))
 
     if truncated:
         resp["summary"] += f" Exported first {MAX_EXPORT_FEATURES} buildings."
@@ -361,88 +558,71 @@ def buildings_higher_than_within_buffer(
 
 
 
-def _rd_to_wgs84_point(pt_rd: Point) -> tuple[float, float]:
-    """Shapely Point in RD -> (lat, lon) in WGS84"""
-    lon, lat = _RD_TO_WGS84.transform(pt_rd.x, pt_rd.y)
-    return float(lat), float(lon)
-
-def _get_hits_in_buffer(gdf: gpd.GeoDataFrame, lat: float, lon: float, radius_m: float) -> tuple[gpd.GeoDataFrame, Point, Any]:
-    """Return (hits_gdf, pt_rd, buf_geom) in EPSG:28992."""
+def _get_hits_in_buffer(gdf: gpd.GeoDataFrame, lat: float, lon: float, radius_m: float) -> tuple[gpd.GeoDataFrame, Point]:
+    """Return (hits_gdf, pt_rd) in EPSG:28992."""
     pt_rd = _to_rd_point(lat, lon)
-    buf = pt_rd.buffer(float(radius_m))
-
-    possible_idx = list(gdf.sindex.intersection(buf.bounds))
-    if not possible_idx:
-        return gdf.iloc[0:0].copy(), pt_rd, buf  # empty same schema
 
-    candidates = gdf.iloc[possible_idx]
-    hits = candidates[candidates.intersects(buf)].copy()
-    return hits, pt_rd, buf
+    hits = gdf.iloc[_query_buffer(gdf, pt_rd, radius_m)]  # empty -> same schema
+    return hits, pt_rd
 
 
 
-def _compute_height_m(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """
-    Adds/overwrites height_m column:
-    height_m = b3_h_nok - b3_h_maaiveld (preferred)
-    fallback: height_m = b3_h_nok
-    """
-    out = gdf.copy()
+def _column_values(gdf: gpd.GeoDataFrame, col: str) -> np.ndarray:
+    return gdf[col].to_numpy(dtype="float64", na_value=np.nan)
 
-    if HEIGHT_TOP_COL not in out.columns:
-        raise ValueError(f"Missing required column: {HEIGHT_TOP_COL}")
-
-    if HEIGHT_GROUND_COL in out.columns:
-        out["height_m"] = out[HEIGHT_TOP_COL] - out[HEIGHT_GROUND_COL]
-    else:
-        out["height_m"] = out[HEIGHT_TOP_COL]
 
-    out = out[out["height_m"].notna()].copy()
-    out = out[out["height_m"] >= 0].copy()
-    return out
+def _valid_or_nan(values: np.ndarray) -> np.ndarray:
+    """float32 copy of values with NaN wherever a value is missing or negative."""
+    values = values.astype(np.float32)
+    values[~(np.isfinite(values) & (values >= 0))] = np.nan
+    return values
 
 
-def _compute_footprint_m2(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+def _add_derived_columns(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
-    Adds/overwrites footprint_m2 column:
-    - prefer b3_opp_grond if present
-    - else use geometry.area (in EPSG:28992 => m²)
+    Precompute height_m, footprint_m2 and volume_m3 once (stored in the cache):
+    - height_m = b3_h_nok - b3_h_maaiveld (fallback: b3_h_nok)
+    - footprint_m2 = b3_opp_grond (fallback: geometry.area, m² in RD)
+    - volume_m3 = b3_volume_lod22/13/12 (fallback: footprint_m2 * height_m)
+    - geometry_wgs84 = the geometry simplified by SIMPLIFY_TOL_M and
+      reprojected to EPSG:4326, for exports
+    Invalid values are NaN; rows are kept so building listings stay complete.
     """
-    out = gdf.copy()
-
-    if FOOTPRINT_COL in out.columns:
-        out["footprint_m2"] = out[FOOTPRINT_COL]
-    else:
-        out["footprint_m2"] = out.geometry.area
-
-    out = out[out["footprint_m2"].notna()].copy()
-    out = out[out["footprint_m2"] >= 0].copy()
-    return out
+    derived = {}
 
+    if HEIGHT_TOP_COL in gdf.columns:
+        h = _column_values(gdf, HEIGHT_TOP_COL)
+        if HEIGHT_GROUND_COL in gdf.columns:
+            h = h - _column_values(gdf, HEIGHT_GROUND_COL)
+        derived["height_m"] = _valid_or_nan(h)
 
+    if FOOTPRINT_COL in gdf.columns:
+        derived["footprint_m2"] = _valid_or_nan(_column_values(gdf, FOOTPRINT_COL))
+    else:
+        derived["footprint_m2"] = _valid_or_nan(shapely.area(gdf.geometry.to_numpy()))
 
-def _compute_volume_m3(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """
-    Adds/overwrites volume_m3 column:
-    - prefer b3_volume_lod22, else lod13, else lod12
-    - else fallback to footprint_m2 * height_m
-    """
-    out = gdf.copy()
+    vol_col = next((c for c in VOLUME_COLS if c in gdf.columns), None)
+    if vol_col is not None:
+        derived["volume_m3"] = _valid_or_nan(_column_values(gdf, vol_col))
+    elif "height_m" in derived:
+        derived["volume_m3"] = derived["footprint_m2"] * derived["height_m"]
+
+    # exports index into this instead of reprojecting every subset;
+    # simplified in RD so the tolerance is in meters
+    simplified = shapely.simplify(gdf.geometry.to_numpy(), SIMPLIFY_TOL_M, preserve_topology=True)
+    derived[WGS84_GEOMETRY_COL] = gpd.GeoSeries(
+        rd_to_wgs84_geometries(simplified), index=gdf.index, crs="EPSG:4326"
+    )
 
-    # choose best available volume column
-    vol_col = next((c for c in VOLUME_COLS if c in out.columns), None)
+    return gdf.assign(**derived)
 
-    if vol_col is not None:
-        out["volume_m3"] = out[vol_col]
-    else:
-        # fallback requires footprint + height
-        out = _compute_height_m(out)
-        out = _compute_footprint_m2(out)
-        out["volume_m3"] = out["footprint_m2"] * out["height_m"]
 
-    out = out[out["volume_m3"].notna()].copy()
-    out = out[out["volume_m3"] >= 0].copy()
-    return out
+def _valid_values(gdf: gpd.GeoDataFrame, col: str) -> np.ndarray:
+    """Valid values of a precomputed column (see _add_derived_columns), as float64 for the reductions."""
+    if col not in gdf.columns:
+        raise ValueError(f"Missing data to compute {col} (see _add_derived_columns).")
+    values = gdf[col].to_numpy()
+    return values[np.isfinite(values)].astype(np.float64)
 
 
 
@@ -454,9 +634,9 @@ def height_stats_within_buffer(lat: float, lon: float, radius_m: float = 400.0)
         return {"ok": False, "error": "radius_m must be between 1 and 15000 meters."}
 
     gdf = load_buildings()
-    hits, pt_rd, buf = _get_hits_in_buffer(gdf, lat, lon, radius_m)
+    hits, pt_rd = _get_hits_in_buffer(gdf, lat, lon, radius_m)
 
-    buffer_fname = _export_buffer_geom(buf, radius_m)
+    buffer_fname = export_buffer_file(lat, lon, radius_m)
 
     if hits.empty:
         return {
@@ -468,36 +648,36 @@ def height_stats_within_buffer(lat: float, lon: float, radius_m: float = 400.0)
                 "center": [lat, lon],
                 "zoom": 14,
                 "layers": [
-                    {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                    {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
+                    marker_layer(lat, lon, "Query point"),
+                    geojson_url_layer("Buffer", buffer_fname),
                 ],
             },
         }
 
-    hits = _compute_height_m(hits)
-    if hits.empty:
+    heights = _valid_values(hits, "height_m")
+    if heights.size == 0:
         return {"ok": True, "count": 0, "stats": {}, "summary": "No valid height values in this area."}
 
     stats = {
-        "min_m": float(hits["height_m"].min()),
-        "avg_m": float(hits["height_m"].mean()),
-        "max_m": float(hits["height_m"].max()),
+        "min_m": float(heights.min()),
+        "avg_m": float(heights.mean()),
+        "max_m": float(heights.max()),
     }
 
     return {
         "ok": True,
-        "count": int(len(hits)),
+        "count": int(heights.size),
         "stats": stats,
         "summary": (
             f"Within {int(radius_m)}m: min={stats['min_m']:.1f}m, "
-            f"avg={stats['avg_m']:.1f}m, max={stats['max_m']:.1f}m (n={len(hits)})."
+            f"avg={stats['avg_m']:.1f}m, max={stats['max_m']:.1f}m (n={heights.size})."
         ),
         "map": {
             "center": [lat, lon],
             "zoom": 14,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": f"Selected Point"},
-                {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
+                marker_layer(lat, lon, f"Selected Point"),
+                geojson_url_layer("Buffer", buffer_fname),
             ],
         },
     }
@@ -517,9 +697,9 @@ def tallest_building_within_buffer(
         return {"ok": False, "error": "radius_m must be between 1 and 15000 meters."}
 
     gdf = load_buildings()
-    hits, pt_rd, buf = _get_hits_in_buffer(gdf, lat, lon, radius_m)
+    hits, pt_rd = _get_hits_in_buffer(gdf, lat, lon, radius_m)
 
-    buffer_fname = _export_buffer_geom(buf, radius_m)
+    buffer_fname = export_buffer_file(lat, lon, radius_m)
 
     if hits.empty:
         return {
@@ -530,35 +710,31 @@ def tallest_building_within_buffer(
                 "center": [lat, lon],
                 "zoom": 14,
                 "layers": [
-                    {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                    {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
+                    marker_layer(lat, lon, "Query point"),
+                    geojson_url_layer("Buffer", buffer_fname),
                 ],
             },
         }
 
-    hits = _compute_height_m(hits)
-    if hits.empty:
+    # height_m is precomputed (float32, NaN if invalid): reduce the array directly
+    h = hits["height_m"].to_numpy()
+    valid_count = int(np.isfinite(h).sum())
+    if valid_count == 0:
         return {"ok": True, "count": 0, "summary": "No valid height values in this area."}
 
-    tallest_row = hits.loc[hits["height_m"].idxmax()].copy()
+    tallest_row = hits.iloc[int(np.nanargmax(h))]
     tallest_height = float(tallest_row["height_m"])
     building_id = tallest_row.get("identificatie")  # optional, depends on your layer
 
-    # robust point inside polygon (better than centroid)
-    rep_pt_rd = tallest_row.geometry.representative_point()
-    t_lat, t_lon = _rd_to_wgs84_point(rep_pt_rd)
-
-    gdf_tallest = gpd.GeoDataFrame([tallest_row], crs=hits.crs)
-
-    keep_cols = [c for c in ["identificatie", "height_m", HEIGHT_TOP_COL, HEIGHT_GROUND_COL] if c in gdf_tallest.columns]
-    gdf_tallest = gdf_tallest[keep_cols + ["geometry"]]
-
-    tallest_fname = export_gpd_to_geojson_file(gdf_tallest, f"tallest_building")
+    keep_cols = [c for c in ["identificatie", "height_m", HEIGHT_TOP_COL, HEIGHT_GROUND_COL] if c in hits.columns]
+    tallest_fname = export_geometry_to_geojson_file(
+        tallest_row.geometry, {c: tallest_row[c] for c in keep_cols}, "tallest_building"
+    )
 
 
     return {
         "ok": True,
-        "count": int(len(hits)),
+        "count": valid_count,
         "tallest": {"id": building_id, "height_m": tallest_height},
         "summary": (
             f"Tallest building within {int(radius_m)}m is {tallest_height:.1f}m"
@@ -568,9 +744,9 @@ def tallest_building_within_buffer(
             "center": [lat, lon],
             "zoom": 15,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
-                {"type": "geojson_url", "name": "Tallest building", "url": f"/{OUTPUT_DIR}/{tallest_fname}"}
+                marker_layer(lat, lon, "Query point"),
+                geojson_url_layer("Buffer", buffer_fname),
+                geojson_url_layer("Tallest building", tallest_fname)
             ],
         },
     }
@@ -588,9 +764,9 @@ def footprint_stats_within_buffer(lat: float, lon: float, radius_m: float = 400.
         return {"ok": False, "error": "radius_m must be between 1 and 15000 meters."}
 
     gdf = load_buildings()
-    hits, pt_rd, buf = _get_hits_in_buffer(gdf, lat, lon, radius_m)
+    hits, pt_rd = _get_hits_in_buffer(gdf, lat, lon, radius_m)
 
-    buffer_fname = _export_buffer_geom(buf, radius_m)
+    buffer_fname = export_buffer_file(lat, lon, radius_m)
 
     if hits.empty:
         return {
@@ -602,36 +778,36 @@ def footprint_stats_within_buffer(lat: float, lon: float, radius_m: float = 400.
                 "center": [lat, lon],
                 "zoom": 14,
                 "layers": [
-                    {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                    {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
+                    marker_layer(lat, lon, "Query point"),
+                    geojson_url_layer("Buffer", buffer_fname),
                 ],
             },
         }
 
-    hits = _compute_footprint_m2(hits)
-    if hits.empty:
+    footprints = _valid_values(hits, "footprint_m2")
+    if footprints.size == 0:
         return {"ok": True, "count": 0, "stats": {}, "summary": "No valid footprint areas in this area."}
 
     stats = {
-        "min_m2": float(hits["footprint_m2"].min()),
-        "avg_m2": float(hits["footprint_m2"].mean()),
-        "max_m2": float(hits["footprint_m2"].max()),
+        "min_m2": float(footprints.min()),
+        "avg_m2": float(footprints.mean()),
+        "max_m2": float(footprints.max()),
     }
 
     return {
         "ok": True,
-        "count": int(len(hits)),
+        "count": int(footprints.size),
         "stats": stats,
         "summary": (
             f"Within {int(radius_m)}m: footprint min={stats['min_m2']:.1f} m², "
-            f"avg={stats['avg_m2']:.1f} m², max={stats['max_m2']:.1f} m² (n={len(hits)})."
+            f"avg={stats['avg_m2']:.1f} m², max={stats['max_m2']:.1f} m² (n={footprints.size})."
         ),
         "map": {
             "center": [lat, lon],
             "zoom": 14,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
+                marker_layer(lat, lon, "Query point"),
+                geojson_url_layer("Buffer", buffer_fname),
             ],
         },
     }
@@ -647,9 +823,9 @@ def total_volume_within_buffer(lat: float, lon: float, radius_m: float = 400.0)
         return {"ok": False, "error": "radius_m must be between 1 and 15000 meters."}
 
     gdf = load_buildings()
-    hits, pt_rd, buf = _get_hits_in_buffer(gdf, lat, lon, radius_m)
+    hits, pt_rd = _get_hits_in_buffer(gdf, lat, lon, radius_m)
 
-    buffer_fname = _export_buffer_geom(buf, radius_m)
+    buffer_fname = export_buffer_file(lat, lon, radius_m)
 
     if hits.empty:
         return {
@@ -661,23 +837,23 @@ def total_volume_within_buffer(lat: float, lon: float, radius_m: float = 400.0)
                 "center": [lat, lon],
                 "zoom": 14,
                 "layers": [
-                    {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                    {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
+                    marker_layer(lat, lon, "Query point"),
+                    geojson_url_layer("Buffer", buffer_fname),
                 ],
             },
         }
 
-    hits = _compute_volume_m3(hits)
-    if hits.empty:
+    volumes = _valid_values(hits, "volume_m3")
+    if volumes.size == 0:
         return {"ok": True, "count": 0, "summary": "No valid volume values in this area."}
 
-    total_m3 = float(hits["volume_m3"].sum())
-    avg_m3 = float(hits["volume_m3"].mean())
-    max_m3 = float(hits["volume_m3"].max())
+    total_m3 = float(volumes.sum())
+    avg_m3 = float(volumes.mean())
+    max_m3 = float(volumes.max())
 
     return {
         "ok": True,
-        "count": int(len(hits)),
+        "count": int(volumes.size),
         "stats": {
             "total_m3": total_m3,
             "avg_m3": avg_m3,
@@ -685,14 +861,94 @@ def total_volume_within_buffer(lat: float, lon: float, radius_m: float = 400.0)
         },
         "summary": (
             f"Within {int(radius_m)}m: total volume ≈ {total_m3:,.0f} m³ "
-            f"(avg={avg_m3:,.0f} m³, max={max_m3:,.0f} m³, n={len(hits)})."
+            f"(avg={avg_m3:,.0f} m³, max={max_m3:,.0f} m³, n={volumes.size})."
         ),
         "map": {
             "center": [lat, lon],
             "zoom": 14,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": "Query point"},
-                {"type": "geojson_url", "name": "Buffer", "url": f"/{OUTPUT_DIR}/{buffer_fname}"},
+                marker_layer(lat, lon, "Query point"),
+                geojson_url_layer("Buffer", buffer_fname),
             ],
         },
     }
+
+
+
+# # ============================================================
+# # Combined height / footprint / volume / tallest analysis
+# # ============================================================
+def analyze_buffer(lat: float, lon: float, radius_m: float = 400.0) -> Dict[str, Any]:
+    """
+    Height, footprint and volume stats plus the tallest building for one
+    buffer, from a single spatial query and buffer export.
+    """
+    if not is_point_in_utrecht(lat, lon):
+        return {"ok": False, "error": utrecht_extent_msg}
+    if radius_m <= 0 or radius_m > 15000:
+        return {"ok": False, "error": "radius_m must be between 1 and 15000 meters."}
+
+    gdf = load_buildings()
+    hits, pt_rd = _get_hits_in_buffer(gdf, lat, lon, radius_m)
+
+    buffer_fname = export_buffer_file(lat, lon, radius_m)
+    layers = [
+        marker_layer(lat, lon, "Query point"),
+        geojson_url_layer("Buffer", buffer_fname),
+    ]
+
+    if hits.empty:
+        return {
+            "ok": True,
+            "count": 0,
+            "summary": f"No buildings found within {int(radius_m)}m.",
+            "map": {"center": [lat, lon], "zoom": 14, "layers": layers},
+        }
+
+    resp: Dict[str, Any] = {"ok": True, "count": int(len(hits))}
+    parts = [f"Within {int(radius_m)}m: {len(hits)} buildings."]
+
+    heights = _valid_values(hits, "height_m")
+    if heights.size:
+        resp["height_stats"] = {
+            "min_m": float(heights.min()),
+            "avg_m": float(heights.mean()),
+            "max_m": float(heights.max()),
+        }
+        parts.append(
+            f"Height min={heights.min():.1f}m, avg={heights.mean():.1f}m, max={heights.max():.1f}m."
+        )
+
+        h = hits["height_m"].to_numpy()
+        tallest_row = hits.iloc[int(np.nanargmax(h))]
+        building_id = tallest_row.get("identificatie")
+        resp["tallest"] = {"id": building_id, "height_m": float(tallest_row["height_m"])}
+
+        keep_cols = [c for c in ["identificatie", "height_m", HEIGHT_TOP_COL, HEIGHT_GROUND_COL] if c in hits.columns]
+        tallest_fname = export_geometry_to_geojson_file(
+            tallest_row.geometry, {c: tallest_row[c] for c in keep_cols}, "tallest_building"
+        )
+        layers.append(geojson_url_layer("Tallest building", tallest_fname))
+
+    footprints = _valid_values(hits, "footprint_m2")
+    if footprints.size:
+        resp["footprint_stats"] = {
+            "min_m2": float(footprints.min()),
+            "avg_m2": float(footprints.mean()),
+            "max_m2": float(footprints.max()),
+        }
+        parts.append(f"Footprint avg={footprints.mean():.1f} m².")
+
+    if "volume_m3" in hits.columns:
+        volumes = _valid_values(hits, "volume_m3")
+        if volumes.size:
+            resp["volume_stats"] = {
+                "total_m3": float(volumes.sum()),
+                "avg_m3": float(volumes.mean()),
+                "max_m3": float(volumes.max()),
+            }
+            parts.append(f"Total volume ≈ {volumes.sum():,.0f} m³.")
+
+    resp["summary"] = " ".join(parts)
+    resp["map"] = {"center": [lat, lon], "zoom": 14, "layers": layers}
+    return resp
@@ -1,17 +1,31 @@
 from __future__ import annotations
 
-from typing import Dict, Any, Tuple, Optional
+from typing import Dict, Any, Iterable, Iterator, Tuple, Optional
+import logging
 import re
 import os
+import time
+from functools import lru_cache
+import uuid
+import gzip
+import hashlib
+import orjson
+import diskcache
+from geopy.exc import GeopyError
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 
 from pyproj import CRS, Transformer
+import numpy as np
+import pandas as pd
+import shapely
 from shapely.geometry.base import BaseGeometry
 from shapely.ops import transform
 from shapely.geometry import Point
 import geopandas as gpd
 
+logger = logging.getLogger(__name__)
+
 
 # ==================================================
 # Geocoding (Nominatim)
@@ -22,14 +36,42 @@ GEOCODER = Nominatim(user_agent="bouwbot-nl (contact: chaudharymac2604@gmail.com
 geocode = RateLimiter(
     GEOCODER.geocode,
     min_delay_seconds=1.1,   # ~1 req/sec
-    swallow_exceptions=True
+    # raise after the retries, so geocode_place can tell an outage from "not found"
+    swallow_exceptions=False,
 )
 
-_GEOCODE_CACHE: Dict[str, Tuple[float, float]] = {}
+# Geocoding results persist on disk (shared by all workers, kept across
+# restarts), so Nominatim's 1 req/sec limit is only paid for new places.
+# Places that could not be geocoded are remembered for a shorter time.
+GEOCODE_CACHE_DIR = "cache/geocode"
+GEOCODE_CACHE_TTL_S = 30 * 24 * 3600
+GEOCODE_MISS_TTL_S = 3600
+
+_geocode_cache = None
+
+
+def _get_geocode_cache() -> diskcache.Cache:
+    """Open lazily, so importing this module doesn't create the cache dir."""
+    global _geocode_cache
+    if _geocode_cache is None:
+        _geocode_cache = diskcache.Cache(GEOCODE_CACHE_DIR)
+    return _geocode_cache
 
 _WGS84_TO_RD = Transformer.from_crs("EPSG:4326", "EPSG:28992", always_xy=True)
 _RD_TO_WGS84 = Transformer.from_crs("EPSG:28992", "EPSG:4326", always_xy=True)
 OUTPUT_DIR = "output"
+# Content-addressed exports are never overwritten, so old ones are swept on
+# write: anything older than the longest tool-result cache TTL (geocode, 24 h
+# in tool_registry) is unused. At most one sweep per interval per process.
+OUTPUT_MAX_AGE_S = 24 * 3600
+OUTPUT_SWEEP_INTERVAL_S = 600
+_EXPORT_NAME_RE = re.compile(r"_[0-9a-f]{16}\.\w+(\.gz)?$")
+_last_output_sweep = 0.0
+# optional precomputed EPSG:4326 copy of an RD frame's geometry, used by the exporters
+WGS84_GEOMETRY_COL = "geometry_wgs84"
+# exported WGS84 coordinates are snapped to this grid (~1 cm), which drops
+# meaningless digits from every coordinate in the GeoJSON
+EXPORT_PRECISION_DEG = 1e-7
 
 
 def _normalize(text: str) -> str:
@@ -41,16 +83,24 @@ def geocode_place(place: str, country_codes: str = "nl") -> Optional[Tuple[float
     Convert a place string to (lat, lon) using Nominatim.
     Default constrained to Netherlands (nl).
     """
-    key = _normalize(place)
-    if key in _GEOCODE_CACHE:
-        return _GEOCODE_CACHE[key]
+    key = f"{country_codes}:{_normalize(place)}"
+    cache = _get_geocode_cache()
+    hit = cache.get(key)  # (lat, lon), False for a known miss, None if unseen
+    if hit is not None:
+        return tuple(hit) if hit else None
 
-    loc = geocode(place, country_codes=country_codes)
+    try:
+        loc = geocode(place, country_codes=country_codes)
+    except GeopyError:
+        # timeout / outage: not a real miss, so nothing is cached
+        logger.warning("Geocoding %r failed", place, exc_info=True)
+        return None
     if not loc:
+        cache.set(key, False, expire=GEOCODE_MISS_TTL_S)
         return None
 
     lat, lon = float(loc.latitude), float(loc.longitude)
-    _GEOCODE_CACHE[key] = (lat, lon)
+    cache.set(key, (lat, lon), expire=GEOCODE_CACHE_TTL_S)
     return lat, lon
 
 
@@ -58,6 +108,15 @@ def geocode_place(place: str, country_codes: str = "nl") -> Optional[Tuple[float
 
 
 
+def marker_layer(lat: float, lon: float, label: str) -> Dict[str, Any]:
+    return {"type": "marker", "lat": lat, "lon": lon, "label": label}
+
+
+def geojson_url_layer(name: str, fname: str) -> Dict[str, Any]:
+    """Map layer for an exported file in OUTPUT_DIR."""
+    return {"type": "geojson_url", "name": name, "url": f"/{OUTPUT_DIR}/{fname}"}
+
+
 def geocode_location(*, place: str) -> Dict[str, Any]:
     coords = geocode_place(place)
     if not coords:
@@ -73,7 +132,7 @@ def geocode_location(*, place: str) -> Dict[str, Any]:
         "map": {
             "center": [lat, lon],
             "zoom": 13,
-            "layers": [{"type": "marker", "lat": lat, "lon": lon, "label": place}],
+            "layers": [marker_layer(lat, lon, place)],
         },
         "message": f"Showing **{place}** on the map."
     }
@@ -82,32 +141,187 @@ def geocode_location(*, place: str) -> Dict[str, Any]:
 def export_gpd_to_geojson_file(gpd: gpd.GeoDataFrame, filename_prefix) -> str:
     """
     Exports gpd to WGS84 GeoJSON and returns filename (not full path).
+    Filenames are content-addressed (<prefix>_<sha1>.geojson), so a URL
+    always points at the same data, also when tool results are cached.
+    """
+    return _write_output_file(_feature_collection(gpd), filename_prefix, "geojson")
+
+
+def export_gpd_to_inline_geojson(gpd: gpd.GeoDataFrame, filename_prefix) -> Tuple[str, Dict[str, Any]]:
+    """
+    Like export_gpd_to_geojson_file, but also returns the FeatureCollection
+    so small layers can be sent inline with the chat response.
     """
-    # simplify in meters (RD)
-    # try:
-    #     gpd = gpd.copy()
-    #     gpd["geometry"] = gpd.geometry.simplify(SIMPLIFY_TOL_M, preserve_topology=True)
-    # except Exception:
-    #     pass
+    data = _feature_collection(gpd)
+    return _write_output_file(data, filename_prefix, "geojson"), orjson.loads(data)
 
+
+def export_geometry_to_geojson_file(geom_rd: BaseGeometry, properties: Dict[str, Any], filename_prefix) -> str:
+    """
+    Export a single RD geometry as a one-feature WGS84 GeoJSON file,
+    without building a GeoDataFrame. Returns filename (not full path).
+    """
+    geom = shapely.transform(geom_rd, lambda xy: np.column_stack(_RD_TO_WGS84.transform(xy[:, 0], xy[:, 1])))
+    feature = (
+        b'{"type":"Feature","properties":'
+        + orjson.dumps(properties, option=orjson.OPT_SERIALIZE_NUMPY, default=_json_default)
+        + b',"geometry":' + shapely.to_geojson(_quantize(geom)).encode() + b"}"
+    )
+    data = b'{"type":"FeatureCollection","features":[' + feature + b"]}"
+    return _write_output_file(data, filename_prefix, "geojson")
+
+
+def _feature_collection(gpd: gpd.GeoDataFrame) -> bytes:
+    """WGS84 FeatureCollection of gpd, encoded as bytes."""
     # convert to WGS84
-    gpd = gpd.to_crs(epsg=4326)
+    gpd = _to_wgs84(gpd)
 
-    # keep only geometry + a couple fields if you want (optional)
-    keep_cols = [c for c in gpd.columns if c != "geometry"]
-    # optionally reduce attributes:
-    # keep_cols = [c for c in ["bag_id", "pand_id", "hoogte"] if c in gpd.columns]
-    gpd = gpd[keep_cols + ["geometry"]]
+    # attributes are already trimmed by the caller (EXPORT_COLUMNS for buildings)
+    return b'{"type":"FeatureCollection","features":[' + b",".join(_encode_features(gpd)) + b"]}"
+
+
+def _to_wgs84(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Reproject to EPSG:4326. Frames carrying a precomputed WGS84_GEOMETRY_COL
+    (the cached buildings) just swap it in; other RD frames go through one
+    vectorized pyproj call on all packed vertices.
+    """
+    if WGS84_GEOMETRY_COL in gdf.columns:
+        wgs = gdf[WGS84_GEOMETRY_COL].to_numpy()
+        return gdf.drop(columns=WGS84_GEOMETRY_COL).set_geometry(wgs, crs="EPSG:4326")
 
-    # fname = f"{filename_prefix}_{uuid.uuid4().hex}.geojson"
-    fname = f"{filename_prefix}.geojson"
+    if gdf.crs is None or gdf.crs.to_epsg() != 28992:
+        return gdf.to_crs(epsg=4326)
+
+    return gdf.set_geometry(rd_to_wgs84_geometries(gdf.geometry.to_numpy()), crs="EPSG:4326")
+
+
+def rd_to_wgs84_geometries(geoms: np.ndarray) -> np.ndarray:
+    """EPSG:28992 -> EPSG:4326 for an array of geometries (returns new ones)."""
+    coords = shapely.get_coordinates(geoms)
+    lon, lat = _RD_TO_WGS84.transform(coords[:, 0], coords[:, 1])
+    return shapely.set_coordinates(geoms.copy(), np.column_stack([lon, lat]))
+
+
+def _encode_features(gdf: gpd.GeoDataFrame) -> Iterator[bytes]:
+    """
+    Encode each row as a GeoJSON Feature, bypassing the OGR driver:
+    geometries via shapely.to_geojson, properties via orjson (NaN -> null).
+    Features are yielded one at a time, so writers can stream them.
+    """
+    geometries = shapely.to_geojson(_quantize(gdf.geometry.to_numpy()))
+    properties = gdf.drop(columns=gdf.geometry.name).to_dict("records")
+    for props, geom in zip(properties, geometries):
+        yield (
+            b'{"type":"Feature","properties":'
+            + orjson.dumps(props, option=orjson.OPT_SERIALIZE_NUMPY, default=_json_default)
+            + b',"geometry":'
+            + (geom.encode() if geom is not None else b"null")
+            + b"}"
+        )
+
+
+def _quantize(geoms):
+    return shapely.set_precision(geoms, EXPORT_PRECISION_DEG, mode="pointwise")
+
+
+def _json_default(value):
+    if pd.isna(value):
+        return None
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def export_gpd_to_geojsonseq_file(gpd: gpd.GeoDataFrame, filename_prefix) -> str:
+    """
+    Exports gpd to newline-delimited WGS84 GeoJSON (one Feature per line),
+    so the frontend can draw features while the file is still downloading.
+    Returns filename (not full path).
+    """
+    gpd = _to_wgs84(gpd)
+    # written feature by feature, never held as one document in memory
+    lines = (feature + b"\n" for feature in _encode_features(gpd))
+    return _write_output_chunks(lines, filename_prefix, "geojsonl")
+
+
+def _write_output_file(data: bytes, filename_prefix: str, ext: str) -> str:
+    """Write data to OUTPUT_DIR as <prefix>_<sha1>.<ext> plus a gzip copy."""
+    return _write_output_chunks([data], filename_prefix, ext)
+
+
+def _write_output_chunks(chunks: Iterable[bytes], filename_prefix: str, ext: str) -> str:
+    """
+    Stream chunks to OUTPUT_DIR as <prefix>_<sha1>.<ext> plus a gzip copy,
+    hashing as they are written. Files are written to a temp name first so
+    tool calls running in parallel never expose a half-written file to the
+    frontend.
+    """
+    # on write rather than at import; also recreates a cleaned-out dir
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    tmp_path = os.path.join(OUTPUT_DIR, f"{filename_prefix}.{uuid.uuid4().hex}.tmp")
+    sha = hashlib.sha1()
+
+    # pre-compressed sibling, served as-is to clients that accept gzip
+    with open(tmp_path, "wb") as f, gzip.open(f"{tmp_path}.gz", "wb", compresslevel=6) as gz:
+        for chunk in chunks:
+            sha.update(chunk)
+            f.write(chunk)
+            gz.write(chunk)
+
+    fname = f"{filename_prefix}_{sha.hexdigest()[:16]}.{ext}"
     out_path = os.path.join(OUTPUT_DIR, fname)  # relative to app root
+    os.replace(f"{tmp_path}.gz", f"{out_path}.gz")
+    os.replace(tmp_path, out_path)
 
-    # write file
-    gpd.to_file(out_path, driver="GeoJSON")
+    _sweep_old_outputs()
     return fname
 
 
+def _sweep_old_outputs() -> None:
+    """Delete exports (and their .gz copies) older than OUTPUT_MAX_AGE_S."""
+    global _last_output_sweep
+    now = time.time()
+    if now - _last_output_sweep < OUTPUT_SWEEP_INTERVAL_S:
+        return
+    _last_output_sweep = now
+
+    cutoff = now - OUTPUT_MAX_AGE_S
+    with os.scandir(OUTPUT_DIR) as entries:
+        for entry in entries:
+            if not _EXPORT_NAME_RE.search(entry.name):
+                continue  # only content-addressed exports, never other files
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass  # swept by another worker
+
+
+
+def export_buffer_file(lat: float, lon: float, radius_m: float, name: str = "buffer") -> str:
+    """
+    Export the circle of radius_m (meters, RD) around a WGS84 point as
+    GeoJSON, returns filename. Repeat queries for the same point, radius
+    and name reuse the written file.
+    """
+    key = (float(lat), float(lon), float(radius_m), name)
+    fname = _export_buffer_cached(*key)
+    if not os.path.exists(os.path.join(OUTPUT_DIR, fname)):
+        # output dir was cleaned since: write it again
+        _export_buffer_cached.cache_clear()
+        fname = _export_buffer_cached(*key)
+    return fname
+
+
+@lru_cache(maxsize=1024)
+def _export_buffer_cached(lat: float, lon: float, radius_m: float, name: str) -> str:
+    x, y = _WGS84_TO_RD.transform(lon, lat)
+    # 32 segments per quarter circle: < 2 m off a true circle at 15 km
+    geom_rd = Point(x, y).buffer(radius_m, quad_segs=32)
+    # filename is content-addressed, so it changes with the geometry
+    return export_geometry_to_geojson_file(geom_rd, {"name": name, "radius_m": radius_m}, "buffer_geom")
+
 
 def buffer_location(*, place: str, radius_m: int) -> Dict[str, Any]:
     coords = geocode_place(place)
@@ -116,17 +330,7 @@ def buffer_location(*, place: str, radius_m: int) -> Dict[str, Any]:
 
     lat, lon = coords
 
-    x, y = _WGS84_TO_RD.transform(float(lon), float(lat))
-    geom_rd = Point(x, y).buffer(float(radius_m), resolution=64)
-
-    # 2) GeoDataFrame in RD
-    gdf = gpd.GeoDataFrame(
-        [{"name": place, "radius_m": float(radius_m)}],
-        geometry=[geom_rd],
-        crs="EPSG:28992",
-    )
-
-    fname = export_gpd_to_geojson_file(gdf, f"buffer_geom")
+    fname = export_buffer_file(lat, lon, radius_m, place)
 
     return {
         "ok": True,
@@ -137,8 +341,8 @@ def buffer_location(*, place: str, radius_m: int) -> Dict[str, Any]:
             "center": [lat, lon],
             "zoom": 14,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": place},
-                { "type": "geojson_url", "name": 'selected location', "url": f"/{OUTPUT_DIR}/{fname}", }
+                marker_layer(lat, lon, place),
+                geojson_url_layer('selected location', fname)
             ],
         },
         "message": f"Drew a **{radius_m} m** buffer"
@@ -160,17 +364,7 @@ def buffer_point(lat: float, lon: float, radius_m: float = 300) -> Dict[str, Any
     if radius_m <= 0 or radius_m > 15000:
         return {"ok": False, "error": "radius_m must be between 1 and 15000 meters."}
     
-    x, y = _WGS84_TO_RD.transform(float(lon), float(lat))
-    geom_rd = Point(x, y).buffer(float(radius_m), resolution=64)
-
-    # 2) GeoDataFrame in RD
-    gdf = gpd.GeoDataFrame(
-        [{"name": 'Selected point', "radius_m": float(radius_m)}],
-        geometry=[geom_rd],
-        crs="EPSG:28992",
-    )
-
-    fname = export_gpd_to_geojson_file(gdf, f"buffer_geom")
+    fname = export_buffer_file(lat, lon, radius_m, "Selected point")
 
     return {
         "ok": True,
@@ -179,8 +373,8 @@ def buffer_point(lat: float, lon: float, radius_m: float = 300) -> Dict[str, Any
             "center": [lat, lon],
             "zoom": 15,
             "layers": [
-                {"type": "marker", "lat": lat, "lon": lon, "label": "Selected point"},
-                { "type": "geojson_url", "name": 'Selected point', "url": f"/{OUTPUT_DIR}/{fname}", }
+                marker_layer(lat, lon, "Selected point"),
+                geojson_url_layer('Selected point', fname)
             ],
         },
     }
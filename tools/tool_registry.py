@@ -1,5 +1,10 @@
 from __future__ import annotations
-from typing import Dict, Any, Callable
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from functools import wraps
+import hashlib
+import os
+
+import orjson
 
 
 from tools.functions import (
@@ -7,7 +12,7 @@ from tools.functions import (
     buffer_location,
     buffer_point
 )
-from tools.buildings_analysis import buildings_within_buffer,buildings_higher_than_within_buffer , height_stats_within_buffer, tallest_building_within_buffer,footprint_stats_within_buffer,total_volume_within_buffer
+from tools.buildings_analysis import buildings_within_buffer,buildings_higher_than_within_buffer , height_stats_within_buffer, tallest_building_within_buffer,footprint_stats_within_buffer,total_volume_within_buffer,analyze_buffer
 
 
 ToolFn = Callable[..., Dict[str, Any]]
@@ -21,13 +26,95 @@ TOOL_REGISTRY: Dict[str, ToolFn] = {
     "tallest_building_within_buffer": tallest_building_within_buffer,
     "footprint_stats_within_buffer": footprint_stats_within_buffer,
     "total_volume_within_buffer": total_volume_within_buffer,
+    "analyze_buffer": analyze_buffer,
+
+}
 
+
+# -----------------------------
+# Tool result cache (Redis)
+# -----------------------------
+# Tools are deterministic for the same arguments, so successful results are
+# cached in Redis when REDIS_URL is set. Without Redis every call runs.
+TOOL_CACHE_TTL_S: Dict[str, int] = {
+    "geocode_location": 24 * 3600,
 }
+DEFAULT_TOOL_CACHE_TTL_S = 3600
+
+_redis = None
+
+
+def _get_redis():
+    """Connect lazily so REDIS_URL from .env is picked up after load_dotenv()."""
+    global _redis
+    if _redis is None and os.getenv("REDIS_URL"):
+        import redis
+        _redis = redis.Redis.from_url(os.getenv("REDIS_URL"))
+    return _redis
+
+
+def _tool_cache_key(tool_name: str, args: Dict[str, Any]) -> str:
+    payload = tool_name.encode() + b":" + orjson.dumps(args, option=orjson.OPT_SORT_KEYS)
+    return "tool:" + hashlib.sha1(payload).hexdigest()
+
+
+def _outputs_exist(result: Dict[str, Any]) -> bool:
+    """A cached result is only usable while the GeoJSON files it links to exist."""
+    layers = (result.get("map") or {}).get("layers") or []
+    return all(os.path.exists(l["url"].lstrip("/")) for l in layers if l.get("url"))
+
 
+def cached_tool(fn: Callable[[str, Dict[str, Any]], Dict[str, Any]]):
+    @wraps(fn)
+    def wrapper(tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        r = _get_redis()
+        if r is None:
+            return fn(tool_name, args)
 
+        import redis
+        key = _tool_cache_key(tool_name, args)
+        try:
+            cached: Optional[bytes] = r.get(key)
+        except redis.RedisError:
+            return fn(tool_name, args)
+
+        if cached:
+            result = orjson.loads(cached)
+            if _outputs_exist(result):
+                return result
+
+        result = fn(tool_name, args)
+        if result.get("ok"):
+            try:
+                r.setex(key, TOOL_CACHE_TTL_S.get(tool_name, DEFAULT_TOOL_CACHE_TTL_S), orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY))
+            except redis.RedisError:
+                pass
+        return result
+
+    return wrapper
+
+
+@cached_tool
 def call_tool(tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
-    if tool_name not in TOOL_REGISTRY:
+    fn = TOOL_REGISTRY.get(tool_name)
+    if fn is None:
         return {"ok": False, "message": f"Unknown tool: {tool_name}"}
-
-    fn = TOOL_REGISTRY[tool_name]
     return fn(**args)
+
+
+def tool_result_cached(tool_name: str, args: Dict[str, Any]) -> bool:
+    """True if call_tool would answer this call from the Redis cache."""
+    r = _get_redis()
+    if r is None:
+        return False
+
+    import redis
+    try:
+        return bool(r.exists(_tool_cache_key(tool_name, args)))
+    except redis.RedisError:
+        return False
+
+
+def call_tools(calls: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Background job entry point (RQ): run tool calls in order."""
+    return [call_tool(tool_name, args) for tool_name, args in calls]
@@ -133,6 +133,22 @@ geospatial_tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "analyze_buffer",
+            "description": "Height, footprint and volume statistics plus the tallest building within radius (meters) of a point, in one call. Use when the user asks for several of these at once.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "lat": {"type": "number"},
+                    "lon": {"type": "number"},
+                    "radius_m": {"type": "number", "default": 400}
+                },
+                "required": ["lat", "lon"]
+            }
+        }
+    },
 
 
 ]
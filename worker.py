@@ -0,0 +1,24 @@
+"""
+RQ worker for background tool jobs (large-radius building queries).
+
+Run from the project root:
+    python worker.py
+"""
+
+import os
+
+from dotenv import load_dotenv
+from redis import Redis
+from rq import Worker
+
+from tools.buildings_analysis import warmup
+
+
+load_dotenv()
+
+
+if __name__ == "__main__":
+    # Load buildings + spatial index once; every job is forked from this
+    # process and shares the data copy-on-write instead of reloading it.
+    warmup()
+    Worker(["tools"], connection=Redis.from_url(os.environ["REDIS_URL"])).work()